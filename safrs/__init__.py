@@ -92,6 +92,28 @@ class SAFRS:
     DEFAULT_INCLUDED = (
         ""
     )  # change to +all to include everything (slower because relationships will be fetched)
+    # Collection count strategy: "exact", "estimated", "capped" or "none"
+    # this can be overridden with the SAFRSBase _s_count_strategy class attribute
+    COUNT_STRATEGY = "exact"
+    COUNT_CAP = 1000  # max count for the "capped" strategy
+    # Serialize the json responses with orjson (if installed), cfr. SAFRSJSONEncoder.encode
+    FAST_JSON_ENCODER = False
+    # Stream the collection responses (without included resources), cfr. jsonapi.jsonapi_stream_response
+    STREAM_RESPONSES = False
+    # Expose the newline-delimited json export endpoints, e.g. /Users/_export
+    ENABLE_EXPORT = False
+    # Don't add resource and relationship links to the resource objects, cfr. SAFRSBase._s_jsonapi_encode
+    # this can be set for a single request with the compact_links query argument
+    COMPACT_LINKS = False
+    # Cache the encoded GET responses in memory, cfr. cache.py
+    RESPONSE_CACHE = False
+    RESPONSE_CACHE_TTL = 60  # seconds, this can be overridden with the SAFRSBase _s_cache_ttl class attribute
+    RESPONSE_CACHE_SIZE = 32 * 1024 * 1024  # max size of the cached response bodies in bytes
+    # SQLite database file of the cache shared by the worker processes, e.g. "/dev/shm/safrs_cache.db"
+    # if None, the cache is kept in the memory of the process
+    RESPONSE_CACHE_PATH = None
+    # Identical concurrent GET requests share the response of the first request, cfr. cache.SingleFlight
+    COALESCE_REQUESTS = False
     INSTANCE_ENDPOINT_FMT = None
     INSTANCE_URL_FMT = None
     RESOURCE_URL_FMT = None
@@ -14,17 +14,23 @@ from flask_restful_swagger_2 import extract_swagger_path, Extractor
 import safrs
 
 # Import here in order to avoid circular dependencies, (todo: fix)
-from .swagger_doc import swagger_doc, swagger_method_doc, default_paging_parameters
+from .swagger_doc import swagger_doc, swagger_method_doc, swagger_export_doc, default_paging_parameters
 from .swagger_doc import parse_object_doc, swagger_relationship_doc, get_http_methods
 from .errors import ValidationError, GenericError, NotFoundError
 from .config import get_config
-from .jsonapi import SAFRSRestAPI, SAFRSRestMethodAPI, SAFRSRestRelationshipAPI
+from .jsonapi import SAFRSRestAPI, SAFRSRestMethodAPI, SAFRSRestRelationshipAPI, SAFRSExportAPI
 from flask_restful.representations.json import output_json
+from .columnar import COLUMNAR_REPRESENTATIONS, ColumnarPage
+from .json_encoder import MSGPACK_REPRESENTATIONS
+from .cache import get_response_cache
 from flask_restful.utils import OrderedDict
 from functools import wraps
 
 HTTP_METHODS = ["GET", "PUT", "POST", "DELETE", "PATCH"]
-DEFAULT_REPRESENTATIONS = [("application/vnd.api+json", output_json)]
+DEFAULT_REPRESENTATIONS = [
+    ("application/vnd.api+json", output_json)
+] + MSGPACK_REPRESENTATIONS + COLUMNAR_REPRESENTATIONS
+COLUMNAR_MIMETYPES = [mimetype for mimetype, output in COLUMNAR_REPRESENTATIONS]
 
 # pylint: disable=protected-access,invalid-name,line-too-long,logging-format-interpolation,fixme,too-many-branches
 class Api(FRSApiBase):
@@ -57,6 +63,17 @@ class Api(FRSApiBase):
         safrs.dict_merge(swagger_doc, custom_swagger)
         self.representations = OrderedDict(DEFAULT_REPRESENTATIONS)
 
+    def make_response(self, data, *args, **kwargs):
+        """
+            The columnar representations only encode a ColumnarPage, other data
+            (e.g. an error document) is encoded as json: the Content-Type that was set
+            for the requested representation is replaced by the json mimetype
+        """
+        response = super(Api, self).make_response(data, *args, **kwargs)
+        if response.mimetype in COLUMNAR_MIMETYPES and not isinstance(data, ColumnarPage):
+            response.headers["Content-Type"] = self.default_mediatype
+        return response
+
     def expose_object(self, safrs_object, url_prefix="", **properties):
         """
             This methods creates the API url endpoints for the SAFRObjects
@@ -78,6 +95,11 @@ class Api(FRSApiBase):
         """
         self.safrs_object = safrs_object
         safrs_object.url_prefix = url_prefix
+        # create the serialization plan upfront instead of when the first instance is serialized
+        safrs_object._s_get_plan()
+        if get_config("RESPONSE_CACHE"):
+            # create the cache upfront: the writes in this process have to invalidate the shared cache
+            get_response_cache()
         api_class_name = "{}_API".format(safrs_object._s_type)
 
         # tags indicate where in the swagger hierarchy the endpoint will be shown
@@ -119,6 +141,9 @@ class Api(FRSApiBase):
             )
         )
 
+        if get_config("ENABLE_EXPORT"):
+            self.expose_export(url_prefix, tags=tags)
+
         object_doc = parse_object_doc(safrs_object)
         object_doc["name"] = safrs_object._s_type
         self._swagger_object["tags"].append(object_doc)
@@ -180,6 +205,32 @@ class Api(FRSApiBase):
                 api_class, url, endpoint=endpoint, methods=get_http_methods(api_method)
             )
 
+    def expose_export(self, url_prefix, tags):
+        """
+            Expose the bulk export endpoint of the SAFRSObject, e.g. /Users/_export
+        """
+        safrs_object = self.safrs_object
+        CLASSMETHOD_URL_FMT = get_config("CLASSMETHOD_URL_FMT")
+        url = CLASSMETHOD_URL_FMT.format(
+            url_prefix, safrs_object._s_type, SAFRSExportAPI.method_name
+        )
+        ENDPOINT_FMT = get_config("ENDPOINT_FMT")
+        endpoint = ENDPOINT_FMT.format(
+            url_prefix, safrs_object._s_type + "." + SAFRSExportAPI.method_name
+        )
+        api_class_name = "{}_export_API".format(safrs_object._s_type)
+        properties = {"SAFRSObject": safrs_object}
+        api_class = api_decorator(
+            type(api_class_name, (SAFRSExportAPI,), properties),
+            swagger_export_doc(safrs_object, tags),
+        )
+        safrs.log.info(
+            "Exposing {} export on {}, endpoint: {}".format(
+                safrs_object._s_type, url, endpoint
+            )
+        )
+        self.add_resource(api_class, url, endpoint=endpoint, methods=["GET"])
+
     def expose_relationship(self, relationship, url_prefix, tags):
         """
             Expose a relationship tp the REST API:
@@ -0,0 +1,724 @@
+"""
+cache.py: in-process cache of the encoded GET responses
+
+The responses are cached by (endpoint, view args, query args, Accept header, ...),
+the cache is a LRU cache limited by the RESPONSE_CACHE_SIZE (bytes of the encoded bodies).
+The entries expire after the TTL of the exposed objects (the _s_cache_ttl class attribute
+or the RESPONSE_CACHE_TTL configuration setting).
+
+Each entry depends on the tables of the resources in the response: the table of the
+requested object, the tables of its relationships and the tables in the include= paths.
+When rows are inserted, updated or deleted in a table (SQLAlchemy mapper and bulk events),
+the entries depending on this table are evicted when the session is committed.
+
+By default the cache is kept in the memory of the process. If RESPONSE_CACHE_PATH is set,
+the cache is stored in a SQLite database file (WAL journal, memory-mapped I/O) that is shared
+by the worker processes on the host, e.g. "/dev/shm/safrs_cache.db". The table generations are
+stored in the same file, so a write in one worker invalidates the entries of all workers.
+
+The cache is enabled with the RESPONSE_CACHE configuration setting. The cache key doesn't
+contain the user (besides the Authorization and Cookie headers): don't enable it when the responses of an
+exposed object depend on the authenticated user (e.g. a _s_query that filters by user)
+
+Identical concurrent GET requests can be coalesced with the COALESCE_REQUESTS setting,
+cfr. SingleFlight. The requests are identical if they have the same cache key, so
+requests with different Authorization or Cookie headers don't share a response
+"""
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+from urllib.parse import parse_qsl
+import sqlalchemy
+from sqlalchemy import event
+from flask import current_app, request
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_date, unquote_etag
+import safrs
+from .db import SAFRSBase
+from .config import get_config
+
+# session.info key of the tables modified in the current transaction
+MODIFIED_TABLES = "safrs_modified_tables"
+
+CacheEntry = collections.namedtuple(
+    "CacheEntry", ["body", "status", "headers", "expires", "tables"]
+)
+
+
+class ResponseCache:
+    """
+        LRU cache of the encoded responses
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # the keys of the entries that depend on a table
+        self.table_keys = collections.defaultdict(set)
+        # the generation of a table is incremented when the table is modified
+        self.generations = collections.Counter()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+            :param key: cache key
+            :return: CacheEntry or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires < time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def get_generation(self, tables):
+        """
+            :param tables: table names
+            :return: the current generation of the tables, cfr. set
+        """
+        with self.lock:
+            return tuple(self.generations[table] for table in tables)
+
+    def set(self, key, entry, generation, max_size):
+        """
+            Add an entry to the cache
+            :param key: cache key
+            :param entry: CacheEntry
+            :param generation: the generation of the entry tables when the response was created,
+                the entry isn't added if a table has been modified since
+            :param max_size: max size of the cache
+        """
+        entry_size = len(entry.body)
+        if entry_size > max_size:
+            return
+        with self.lock:
+            if generation != tuple(self.generations[table] for table in entry.tables):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += entry_size
+            for table in entry.tables:
+                self.table_keys[table].add(key)
+            while self.size > max_size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, tables):
+        """
+            Evict the entries that depend on the tables
+            :param tables: names of the modified tables
+        """
+        with self.lock:
+            for table in tables:
+                self.generations[table] += 1
+                for key in list(self.table_keys.pop(table, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """
+            Evict all entries
+        """
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+
+    def _remove(self, key):
+        """
+            Remove an entry, the lock must be held
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry.body)
+        for table in entry.tables:
+            keys = self.table_keys.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.table_keys[table]
+
+
+
+class SharedResponseCache:
+    """
+        Response cache stored in a SQLite database file, shared by the processes on a host.
+        The entries are evicted in insertion order when the cache is full.
+        The generation of the entry tables is stored with the entry,
+        entries with outdated generations are discarded when they're read
+    """
+
+    # the database file is memory-mapped, the bodies are read without read() system calls.
+    # A body is copied once, from the mapped pages to the bytes object of the response:
+    # the sqlite3 module doesn't expose the pages as buffers
+    mmap_size = 256 * 1024 * 1024
+    timeout = 5
+    # the size of the bodies is kept in the metadata table by the triggers,
+    # so the cache size is known without scanning the entries
+    schema = [
+        "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, body BLOB, status INTEGER, "
+        "headers TEXT, expires REAL, tables TEXT, generation TEXT, created REAL)",
+        "CREATE INDEX IF NOT EXISTS entries_created ON entries (created)",
+        "CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, generation INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN "
+        "UPDATE metadata SET value = value + length(NEW.body) WHERE name = 'size'; END",
+        "CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN "
+        "UPDATE metadata SET value = value - length(OLD.body) WHERE name = 'size'; END",
+        "INSERT OR IGNORE INTO metadata SELECT 'size', coalesce(sum(length(body)), 0) FROM entries",
+    ]
+
+    def __init__(self, path):
+        """
+            :param path: path of the database file
+        """
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        """
+            :return: the sqlite connection of the current process and thread
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            # the connections can't be shared with forked processes
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA mmap_size={}".format(int(self.mmap_size)))
+            connection.execute("BEGIN IMMEDIATE")
+            for statement in self.schema:
+                connection.execute(statement)
+            connection.execute("COMMIT")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def get_key(key):
+        """
+            :param key: cache key tuple
+            :return: key string
+        """
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+            :param key: cache key
+            :return: CacheEntry or None
+        """
+        try:
+            row = self.connection.execute(
+                "SELECT body, status, headers, expires, tables, generation FROM entries WHERE key = ?",
+                (self.get_key(key),),
+            ).fetchone()
+            if row is None:
+                return None
+            body, status, headers, expires, tables, generation = row
+            tables = tuple(tables.split(",")) if tables else ()
+            if expires < time.time() or generation != self.format_generation(self.get_generation(tables)):
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (self.get_key(key),))
+                return None
+        except sqlite3.Error as exc:
+            safrs.log.warning("Response cache error: {}".format(exc))
+            return None
+        headers = [tuple(header) for header in json.loads(headers)]
+        return CacheEntry(body, status, headers, expires, tables)
+
+    def get_generation(self, tables):
+        """
+            :param tables: table names
+            :return: the current generation of the tables
+        """
+        if not tables:
+            return ()
+        try:
+            rows = self.connection.execute(
+                "SELECT name, generation FROM generations WHERE name IN ({})".format(
+                    ",".join("?" * len(tables))
+                ),
+                tables,
+            ).fetchall()
+        except sqlite3.Error as exc:
+            safrs.log.warning("Response cache error: {}".format(exc))
+            return None
+        generations = dict(rows)
+        return tuple(generations.get(table, 0) for table in tables)
+
+    @staticmethod
+    def format_generation(generation):
+        """
+            :param generation: tuple of table generations
+            :return: generation string
+        """
+        if generation is None:
+            return None
+        return ",".join(str(value) for value in generation)
+
+    def set(self, key, entry, generation, max_size):
+        """
+            Add an entry to the cache
+            :param key: cache key
+            :param entry: CacheEntry
+            :param generation: the generation of the entry tables when the response was created,
+                the entry isn't added if a table has been modified since
+            :param max_size: max size of the cache
+        """
+        if generation is None or len(entry.body) > max_size:
+            return
+        connection = self.connection
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if generation == self.get_generation(entry.tables):
+                    # INSERT OR REPLACE doesn't fire the delete trigger
+                    connection.execute("DELETE FROM entries WHERE key = ?", (self.get_key(key),))
+                    connection.execute(
+                        "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            self.get_key(key),
+                            entry.body,
+                            entry.status,
+                            json.dumps(entry.headers),
+                            entry.expires,
+                            ",".join(entry.tables),
+                            self.format_generation(generation),
+                            time.time(),
+                        ),
+                    )
+                    self.evict(max_size)
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as exc:
+            safrs.log.warning("Response cache error: {}".format(exc))
+
+    def evict(self, max_size):
+        """
+            Remove the expired entries and the oldest entries if the cache is full
+            :param max_size: max size of the cache
+        """
+        connection = self.connection
+        if self.get_size() <= max_size:
+            return
+        connection.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+        size = self.get_size()
+        while size > max_size:
+            rows = connection.execute(
+                "SELECT key, length(body) FROM entries ORDER BY created LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for key, body_size in rows:
+                if size <= max_size:
+                    break
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                size -= body_size
+
+    def get_size(self):
+        """
+            :return: the size of the cached bodies
+        """
+        row = self.connection.execute("SELECT value FROM metadata WHERE name = 'size'").fetchone()
+        return row[0] if row else 0
+
+    def invalidate(self, tables):
+        """
+            Increment the generation of the tables, this invalidates the
+            entries that depend on the tables in all processes
+            :param tables: names of the modified tables
+        """
+        connection = self.connection
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for table in tables:
+                connection.execute(
+                    "INSERT OR IGNORE INTO generations VALUES (?, 0)", (table,)
+                )
+                connection.execute(
+                    "UPDATE generations SET generation = generation + 1 WHERE name = ?",
+                    (table,),
+                )
+            connection.execute("COMMIT")
+        except sqlite3.Error as exc:
+            safrs.log.warning("Response cache error: {}".format(exc))
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+
+    def clear(self):
+        """
+            Evict all entries
+        """
+        try:
+            self.connection.execute("DELETE FROM entries")
+        except sqlite3.Error as exc:
+            safrs.log.warning("Response cache error: {}".format(exc))
+
+
+# response caches by RESPONSE_CACHE_PATH (None for the in-process cache)
+RESPONSE_CACHES = {}
+CACHE_LOCK = threading.Lock()
+
+
+def get_response_cache():
+    """
+        :return: the response cache of the app, cfr. RESPONSE_CACHE_PATH
+    """
+    path = get_config("RESPONSE_CACHE_PATH") or None
+    response_cache = RESPONSE_CACHES.get(path)
+    if response_cache is None:
+        with CACHE_LOCK:
+            if not RESPONSE_CACHES:
+                listen()
+            response_cache = RESPONSE_CACHES.get(path)
+            if response_cache is None:
+                response_cache = ResponseCache() if path is None else SharedResponseCache(path)
+                RESPONSE_CACHES[path] = response_cache
+    return response_cache
+
+
+def listen():
+    """
+        Register the SQLAlchemy events that invalidate the caches
+    """
+    for event_name in ("after_insert", "after_update", "after_delete"):
+        event.listen(SAFRSBase, event_name, on_mapper_event, propagate=True)
+    event.listen(sqlalchemy.orm.Session, "after_bulk_update", on_bulk_event)
+    event.listen(sqlalchemy.orm.Session, "after_bulk_delete", on_bulk_event)
+    event.listen(sqlalchemy.orm.Session, "after_commit", on_commit)
+    event.listen(sqlalchemy.orm.Session, "after_rollback", on_rollback)
+
+
+def invalidate(tables):
+    """
+        Evict the entries that depend on the tables from the caches
+        :param tables: names of the modified tables
+    """
+    safrs.log.debug("Invalidating the response cache for {}".format(sorted(tables)))
+    for response_cache in list(RESPONSE_CACHES.values()):
+        response_cache.invalidate(tables)
+
+
+def get_mapper_tables(mapper):
+    """
+        :param mapper: sqla mapper
+        :return: names of the tables of the mapper (and the secondary tables of its relationships)
+    """
+    result = {table.name for table in mapper.tables}
+    for relationship in mapper.relationships:
+        if relationship.secondary is not None:
+            result.add(relationship.secondary.name)
+    return result
+
+
+def get_dependent_tables(safrs_objects, include_tree):
+    """
+        The tables a response depends on: the tables of the objects, of their relationships
+        and of the relationships in the include= paths
+        :param safrs_objects: the SAFRSBase subclasses in the response
+        :param include_tree: parsed include= paths, cfr. SAFRSRequest.include_tree
+        :return: sorted tuple of table names
+    """
+    result = set()
+
+    def add_mapper(mapper, include_tree):
+        result.update(get_mapper_tables(mapper))
+        for relationship in mapper.relationships:
+            result.update(get_mapper_tables(relationship.mapper))
+            if relationship.key in include_tree:
+                add_mapper(relationship.mapper, include_tree[relationship.key])
+
+    for safrs_object in safrs_objects:
+        add_mapper(safrs_object.__mapper__, include_tree)
+    return tuple(sorted(result))
+
+
+def get_cache_key():
+    """
+        :return: cache key of the current request
+    """
+    return (
+        request.url_root,
+        request.endpoint,
+        tuple(sorted((request.view_args or {}).items())),
+        tuple(sorted(parse_qsl(request.query_string.decode("utf-8"), keep_blank_values=True))),
+        request.headers.get("Accept"),
+        # the user (or session) of the request
+        request.headers.get("Authorization"),
+        request.headers.get("Cookie"),
+    )
+
+
+def get_cache_ttl(safrs_objects):
+    """
+        :param safrs_objects: the SAFRSBase subclasses in the response
+        :return: the smallest ttl of the objects
+    """
+    ttls = [getattr(safrs_object, "_s_cache_ttl", None) for safrs_object in safrs_objects]
+    default_ttl = get_config("RESPONSE_CACHE_TTL")
+    return min(default_ttl if ttl is None else ttl for ttl in ttls)
+
+
+class InFlightRequest:
+    """
+        A request that is being processed by SingleFlight
+    """
+
+    # pylint: disable=too-few-public-methods
+    __slots__ = ("event", "entry")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.entry = None
+
+
+class SingleFlight:
+    """
+        Coalesce identical concurrent requests: the first request (the leader) creates
+        the response, the requests with the same key that arrive while the leader is
+        busy wait for it and share its encoded response.
+        The waiting is done with threading primitives, so this also works for gevent
+        greenlets when threading is monkey-patched
+    """
+
+    # seconds a request waits for the leader before creating its own response
+    timeout = 30
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fun):
+        """
+            :param key: request key
+            :param fun: function that returns a (response, CacheEntry) tuple, the entry is
+                        None if the response can't be shared
+            :return: (response, entry) tuple, response is None if the entry of the leader is returned
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = InFlightRequest()
+
+        if not leader:
+            if flight.event.wait(self.timeout) and flight.entry is not None:
+                return None, flight.entry
+            # the leader failed or its response can't be shared
+            return fun()
+
+        try:
+            response, flight.entry = fun()
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return response, flight.entry
+
+
+single_flight = SingleFlight()
+
+
+def get_cache_entry(response, expires, tables):
+    """
+        :param response: flask response
+        :param expires: expiration time of the entry
+        :param tables: tables the response depends on
+        :return: CacheEntry of the response, None if the response can't be cached
+    """
+    if (
+        isinstance(response, current_app.response_class)
+        and response.status_code == 200
+        and not response.is_streamed
+    ):
+        return CacheEntry(
+            response.get_data(),
+            response.status_code,
+            list(response.headers),
+            expires,
+            tables,
+        )
+    return None
+
+
+def not_modified_response(validators):
+    """
+        :param validators: (etag, last_modified) tuple, cfr. get_validators
+        :return: a 304 Not Modified response if the request preconditions match the validators
+                 None otherwise
+    """
+    if validators is None:
+        return None
+    etag, last_modified = validators
+    if request.if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is present
+        not_modified = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        not_modified = last_modified <= request.if_modified_since.replace(tzinfo=None)
+    else:
+        not_modified = False
+    if not not_modified:
+        return None
+    response = current_app.response_class(status=304)
+    set_validators(response, validators)
+    return response
+
+
+def set_validators(response, validators):
+    """
+        Set the ETag and Last-Modified response headers
+        :param response: flask response
+        :param validators: (etag, last_modified) tuple, cfr. get_validators
+        :return: response
+    """
+    if validators is not None:
+        etag, last_modified = validators
+        # weak: the json encoding isn't guaranteed to be byte-identical
+        response.set_etag(etag, weak=True)
+        if last_modified is not None:
+            response.last_modified = last_modified
+    return response
+
+
+def get_entry_validators(entry):
+    """
+        :param entry: CacheEntry
+        :return: the (etag, last_modified) validators of the cached response, cfr. jsonapi.get_validators
+    """
+    headers = Headers(entry.headers)
+    etag = headers.get("ETag")
+    if etag is None:
+        return None
+    last_modified = parse_date(headers.get("Last-Modified"))
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=None)
+    return unquote_etag(etag)[0], last_modified
+
+
+def make_cached_response(entry, cache_status):
+    """
+        :param entry: CacheEntry
+        :param cache_status: X-Cache header value
+        :return: flask response, 304 Not Modified if the request preconditions
+                 match the validators of the cached response
+    """
+    response = not_modified_response(get_entry_validators(entry))
+    if response is None:
+        response = current_app.response_class(entry.body, status=entry.status, headers=entry.headers)
+    response.headers["X-Cache"] = cache_status
+    return response
+
+
+def cached_response(fun):
+    """
+        Decorator for the GET methods of the SAFRSRestAPI and SAFRSRestRelationshipAPI resources:
+        - return the cached response if there is one, otherwise cache the response (RESPONSE_CACHE)
+        - share the response of identical concurrent requests (COALESCE_REQUESTS)
+    """
+
+    @wraps(fun)
+    def method_wrapper(self, *args, **kwargs):
+        use_cache = get_config("RESPONSE_CACHE")
+        coalesce = get_config("COALESCE_REQUESTS")
+        if request.method != "GET" or not (use_cache or coalesce):
+            # get() is also called to create the PATCH and POST responses
+            return fun(self, *args, **kwargs)
+
+        safrs_objects = [
+            cls
+            for cls in (
+                self.SAFRSObject,
+                getattr(self, "parent_class", None),
+                getattr(self, "child_class", None),
+            )
+            if isinstance(cls, type) and issubclass(cls, SAFRSBase)
+        ]
+        ttl = get_cache_ttl(safrs_objects) if use_cache else 0
+        if not ttl and not coalesce:
+            return fun(self, *args, **kwargs)
+
+        key = get_cache_key()
+        response_cache = get_response_cache() if ttl else None
+        if response_cache is not None:
+            entry = response_cache.get(key)
+            if entry is not None:
+                return make_cached_response(entry, "HIT")
+
+        def get_response():
+            """
+                :return: response, CacheEntry
+            """
+            tables = ()
+            if response_cache is not None:
+                tables = get_dependent_tables(safrs_objects, request.include_tree)
+                generation = response_cache.get_generation(tables)
+            response = fun(self, *args, **kwargs)
+            entry = get_cache_entry(response, time.time() + ttl, tables)
+            if entry is not None and response_cache is not None:
+                response_cache.set(key, entry, generation, get_config("RESPONSE_CACHE_SIZE"))
+                response.headers["X-Cache"] = "MISS"
+            return response, entry
+
+        if not coalesce:
+            return get_response()[0]
+        response, entry = single_flight.do(key, get_response)
+        if response is None:
+            return make_cached_response(entry, "COALESCED")
+        return response
+
+    return method_wrapper
+
+
+def get_session_tables(session):
+    """
+        :param session: sqla session
+        :return: set of the tables modified in the session transaction
+    """
+    return session.info.setdefault(MODIFIED_TABLES, set())
+
+
+def on_mapper_event(mapper, connection, target):
+    """
+        after_insert, after_update, after_delete mapper event:
+        register the modified tables in the session
+    """
+    session = sqlalchemy.orm.object_session(target)
+    if session is not None:
+        get_session_tables(session).update(get_mapper_tables(mapper))
+    else:
+        invalidate(get_mapper_tables(mapper))
+
+
+def on_bulk_event(update_context):
+    """
+        after_bulk_update, after_bulk_delete session event:
+        register the modified tables in the session
+    """
+    mapper = getattr(update_context, "mapper", None)
+    if mapper is not None:
+        get_session_tables(update_context.session).update(get_mapper_tables(mapper))
+
+
+def on_commit(session):
+    """
+        after_commit session event: evict the entries of the modified tables
+    """
+    tables = session.info.pop(MODIFIED_TABLES, None)
+    if tables:
+        invalidate(tables)
+
+
+def on_rollback(session):
+    """
+        after_rollback session event: the modifications are discarded
+    """
+    session.info.pop(MODIFIED_TABLES, None)
@@ -0,0 +1,205 @@
+"""
+columnar.py: columnar representations of the collection responses:
+
+- Apache Arrow IPC stream (application/vnd.apache.arrow.stream), if pyarrow is installed
+- CSV (text/csv)
+
+A client requests a columnar response with the Accept header, cfr. SAFRSRestAPI.get.
+The columns are the jsonapi id and the attributes (cfr. fields[]), the pagination
+links are returned in the Link header.
+"""
+import csv
+import io
+import datetime
+import sqlalchemy
+from flask import current_app, request
+from flask_restful.representations.json import output_json
+import safrs
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.types
+except ImportError:
+    pyarrow = None
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+CSV_MIMETYPE = "text/csv"
+JSON_MIMETYPES = ["application/vnd.api+json", "application/json"]
+
+
+class ColumnarPage:
+    """
+        A page of a collection that will be encoded by a columnar representation
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, safrs_object, instances, links=None, count=None):
+        """
+            :param safrs_object: SAFRSBase subclass
+            :param instances: safrs_object instances
+            :param links: pagination links
+            :param count: collection count
+        """
+        self.safrs_object = safrs_object
+        self.instances = instances
+        self.links = links or {}
+        self.count = count
+
+    def get_columns(self):
+        """
+            :return: list of (name, sqla column, getter) tuples, the id column is first
+        """
+        safrs_object = self.safrs_object
+        pk_columns = safrs_object.id_type.columns
+        id_column = pk_columns[0] if len(pk_columns) == 1 else None
+        result = [("id", id_column, lambda instance: instance.jsonapi_id)]
+
+        plan = safrs_object._s_get_plan()
+        fields = request.fields.get(plan.type, plan.attribute_names)
+        mapper_columns = safrs_object.__mapper__.columns
+        for attr, getter in plan.attributes:
+            if attr in fields:
+                # "type" is exposed as "Type", cfr. SAFRSBase._s_jsonapi_attrs
+                column = mapper_columns.get("type" if attr == "Type" else attr)
+                result.append((attr, column, getter))
+        return result
+
+
+def get_columnar_mimetype():
+    """
+        :return: the columnar mimetype requested in the Accept header,
+                 None if the client prefers json
+    """
+    columnar_mimetypes = [mimetype for mimetype, output in COLUMNAR_REPRESENTATIONS]
+    best_match = request.accept_mimetypes.best_match(JSON_MIMETYPES + columnar_mimetypes)
+    if best_match in columnar_mimetypes:
+        return best_match
+    return None
+
+
+def get_link_header(links):
+    """
+        Format the pagination links as a Link header (RFC 8288)
+        :param links: pagination links dict
+        :return: header value
+    """
+    return ", ".join('<{}>; rel="{}"'.format(url, rel) for rel, url in sorted(links.items()))
+
+
+def make_columnar_response(body, code, headers, page):
+    """
+        Create the flask response for a columnar page
+    """
+    response = current_app.response_class(body, status=code)
+    response.headers.extend(headers or {})
+    if page.links:
+        response.headers["Link"] = get_link_header(page.links)
+    return response
+
+
+def format_csv_value(value):
+    """
+        Format a value like SAFRSJSONEncoder
+    """
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def output_csv(data, code, headers=None):
+    """
+        CSV representation of a ColumnarPage, other data is returned as json
+    """
+    if not isinstance(data, ColumnarPage):
+        return output_json(data, code, headers)
+
+    columns = data.get_columns()
+    body = io.StringIO()
+    writer = csv.writer(body)
+    writer.writerow([name for name, column, getter in columns])
+    for instance in data.instances:
+        writer.writerow([format_csv_value(getter(instance)) for name, column, getter in columns])
+
+    return make_columnar_response(body.getvalue(), code, headers, data)
+
+
+def get_arrow_type(column):
+    """
+        Map the sqla column type to an arrow type
+        :param column: sqla column or None
+        :return: pyarrow DataType
+    """
+    col_type = getattr(column, "type", None)
+    if isinstance(col_type, sqlalchemy.Boolean):
+        return pyarrow.bool_()
+    if isinstance(col_type, sqlalchemy.SmallInteger):
+        return pyarrow.int16()
+    if isinstance(col_type, sqlalchemy.Integer):
+        return pyarrow.int64()
+    if isinstance(col_type, sqlalchemy.Float):
+        return pyarrow.float64()
+    if isinstance(col_type, sqlalchemy.Numeric):
+        if col_type.asdecimal and col_type.precision and col_type.precision <= 38:
+            return pyarrow.decimal128(col_type.precision, col_type.scale or 0)
+        return pyarrow.float64()
+    if isinstance(col_type, sqlalchemy.DateTime):
+        return pyarrow.timestamp("us", tz="UTC" if col_type.timezone else None)
+    if isinstance(col_type, sqlalchemy.Date):
+        return pyarrow.date32()
+    if isinstance(col_type, sqlalchemy.Time):
+        return pyarrow.time64("us")
+    if isinstance(col_type, sqlalchemy.LargeBinary):
+        return pyarrow.binary()
+    return pyarrow.string()
+
+
+def get_arrow_array(values, arrow_type):
+    """
+        Create an arrow array, the values are converted to strings
+        if they don't match the arrow type
+    """
+    if pyarrow.types.is_floating(arrow_type):
+        values = [None if value is None else float(value) for value in values]
+    elif pyarrow.types.is_string(arrow_type):
+        values = [None if value is None else str(value) for value in values]
+    try:
+        return pyarrow.array(values, type=arrow_type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError) as exc:
+        safrs.log.warning("Failed to convert values to {}: {}".format(arrow_type, exc))
+        return pyarrow.array(
+            [None if value is None else str(format_csv_value(value)) for value in values],
+            type=pyarrow.string(),
+        )
+
+
+def output_arrow(data, code, headers=None):
+    """
+        Arrow IPC stream representation of a ColumnarPage, other data is returned as json
+    """
+    if not isinstance(data, ColumnarPage):
+        return output_json(data, code, headers)
+
+    arrays = []
+    names = []
+    for name, column, getter in data.get_columns():
+        values = [getter(instance) for instance in data.instances]
+        arrays.append(get_arrow_array(values, get_arrow_type(column)))
+        names.append(name)
+    table = pyarrow.Table.from_arrays(arrays, names=names)
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return make_columnar_response(sink.getvalue().to_pybytes(), code, headers, data)
+
+
+# Registered in Api.representations, cfr. _api.DEFAULT_REPRESENTATIONS
+COLUMNAR_REPRESENTATIONS = [(CSV_MIMETYPE, output_csv)]
+if pyarrow is not None:
+    COLUMNAR_REPRESENTATIONS.insert(0, (ARROW_MIMETYPE, output_arrow))
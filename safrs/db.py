@@ -6,10 +6,13 @@
 # SQLAlchemy database schemas
 # pylint: disable=logging-format-interpolation,no-self-argument,no-member,line-too-long,fixme,protected-access
 import inspect
+import collections
 import datetime
 import logging
+import operator
 from urllib.parse import urljoin
-from flask import request, url_for
+from flask import current_app, request, url_for
+from werkzeug.urls import url_quote
 from flask_sqlalchemy import Model
 import sqlalchemy
 from sqlalchemy import orm
@@ -66,6 +69,49 @@ SQLALCHEMY_SWAGGER2_TYPE = {
     "UUID": "string",
 }
 
+#
+# Serialization plan
+#
+# max number of ids in an IN clause, cfr. SAFRSBase._s_get_instances
+IN_CHUNK_SIZE = 500
+# placeholder for the id when creating the instance url templates
+URL_ID_MARKER = "__safrs_id__"
+# max number of url templates per class: the url root depends on the Host header of the client
+URL_TEMPLATES_SIZE = 64
+
+
+class SerializationPlan:
+    """
+        Serialization data of a SAFRSBase subclass that doesn't change between requests:
+        it's created once per class (cfr. SAFRSBase._s_get_plan) so the attributes and
+        relationships don't have to be looked up for every serialized instance
+    """
+
+    __slots__ = ("type", "attributes", "attribute_names", "relationships", "url_templates")
+
+    def __init__(self, cls):
+        """
+            :param cls: SAFRSBase subclass
+        """
+        attributes = []
+        for attr in cls._s_jsonapi_attrs:
+            if attr == "Type":
+                # read the "type" column directly instead of the Type property
+                attr_name = "type"
+            elif not hasattr(cls, attr) and hasattr(cls, attr.lower()):
+                attr_name = attr.lower()
+            else:
+                attr_name = attr
+            attributes.append((attr, operator.attrgetter(attr_name)))
+
+        self.type = cls._s_type
+        self.attributes = tuple(attributes)
+        self.attribute_names = frozenset(attr for attr, getter in attributes)
+        self.relationships = tuple(cls.__mapper__.relationships)
+        # LRU of the instance url templates by (url map, url root), cfr. SAFRSBase._s_get_url_template
+        self.url_templates = collections.OrderedDict()
+
+
 #
 # SAFRSBase superclass
 #
@@ -89,15 +135,30 @@ class SAFRSBase(Model):
     http_methods = {}  # http methods, used in case of override
     url_prefix = ""
     allow_client_generated_ids = False
+    # strategy used to count collections: "exact", "estimated", "capped" or "none"
+    # if None, the COUNT_STRATEGY configuration setting is used
+    _s_count_strategy = None
+    # name of the column with the modification time of the rows, e.g. "updated_at"
+    # it's used for the ETag and Last-Modified validators, cfr. jsonapi.get_validators
+    _s_modified_column = None
+    # seconds the GET responses are cached if RESPONSE_CACHE is enabled, 0 disables the cache
+    # if None, the RESPONSE_CACHE_TTL configuration setting is used
+    _s_cache_ttl = None
 
     def __new__(cls, **kwargs):
         """
             If an object with given arguments already exists, this object is instantiated
         """
+        # the id_type class is created (and set on cls) when it's accessed for the first time
+        id_type = cls.id_type
+        if "id" not in kwargs:
+            # No id to look up, this is also the case when sqlalchemy
+            # instantiates the objects it loads from the database
+            return object.__new__(cls)
         # Fetch the PKs from the kwargs so we can lookup the corresponding object
-        primary_keys = cls.id_type.get_pks(kwargs.get("id", ""))
+        primary_keys = id_type.get_pks(kwargs["id"])
         # Lookup the object with the PKs
-        instance = cls.query.filter_by(**primary_keys).first()
+        instance = cls._s_get_by_pks(primary_keys)
         if not instance:
             instance = object.__new__(cls)
         else:
@@ -342,7 +403,7 @@ class SAFRSBase(Model):
 
         if not id is None or not failsafe:
             try:
-                instance = cls.query.filter_by(**primary_keys).first()
+                instance = cls._s_get_by_pks(primary_keys)
             except Exception as exc:
                 safrs.log.error("get_instance : %s", str(exc))
 
@@ -352,6 +413,60 @@ class SAFRSBase(Model):
                 raise NotFoundError('Invalid "{}" ID "{}"'.format(cls.__name__, id))
         return instance
 
+    @classmethod
+    def _s_get_instances(cls, ids):
+        """
+            Retrieve the instances with the given ids with one query per IN_CHUNK_SIZE ids
+            :param ids: list of jsonapi ids
+            :return: list of instances, in the order of the ids.
+                     An error is raised for the ids that don't exist
+        """
+        pk_columns = cls.__mapper__.primary_key
+        pk_attrs = [cls.__mapper__.get_property_by_column(column).key for column in pk_columns]
+        idents = []
+        for id in ids:
+            primary_keys = cls.id_type.get_pks(id)
+            idents.append(tuple(primary_keys.get(column.name) for column in pk_columns))
+
+        instances = {}
+        unique_idents = list(set(idents))
+        for i in range(0, len(unique_idents), IN_CHUNK_SIZE):
+            chunk = unique_idents[i : i + IN_CHUNK_SIZE]
+            if len(pk_attrs) == 1:
+                criterion = getattr(cls, pk_attrs[0]).in_([ident[0] for ident in chunk])
+            else:
+                # (a, b) IN ((..), (..)) isn't supported by all dialects
+                criterion = sqlalchemy.or_(
+                    *[
+                        sqlalchemy.and_(
+                            *[getattr(cls, attr) == value for attr, value in zip(pk_attrs, ident)]
+                        )
+                        for ident in chunk
+                    ]
+                )
+            for instance in cls.query.filter(criterion):
+                instances[tuple(cls.__mapper__.primary_key_from_instance(instance))] = instance
+
+        missing = [str(id) for id, ident in zip(ids, idents) if ident not in instances]
+        if missing:
+            raise NotFoundError('Invalid "{}" IDs: {}'.format(cls.__name__, ", ".join(missing)))
+        return [instances[ident] for ident in idents]
+
+    @classmethod
+    def _s_get_by_pks(cls, primary_keys):
+        """
+            Lookup an instance by its primary keys with query.get(): if the instance is
+            in the identity map of the session, it's returned without querying the db
+            :param primary_keys: pk dict, cfr. id_type.get_pks
+            :return: instance or None
+        """
+        try:
+            ident = [primary_keys[column.name] for column in cls.__mapper__.primary_key]
+            return cls.query.get(ident)
+        except (KeyError, sqlalchemy.exc.InvalidRequestError):
+            # the pk columns don't match the mapper or the query has criteria
+            return cls.query.filter_by(**primary_keys).first()
+
     def _s_clone(self, **kwargs):
         """
             Clone an object: copy the parameters and create a new id
@@ -380,28 +495,39 @@ class SAFRSBase(Model):
             this method will be called by SAFRSJSONEncoder to serialize objects
         """
         result = {}
+        plan = self._s_get_plan()
         if fields is None:
             # Check if fields have been provided in the request
             if request:
-                fields = request.fields.get(self._s_type, self._s_jsonapi_attrs)
+                fields = request.fields.get(plan.type, plan.attribute_names)
             else:
-                fields = self._s_jsonapi_attrs
+                fields = plan.attribute_names
 
         # filter the relationships, id & type from the data
-        for attr in self._s_jsonapi_attrs:
-            if not attr in fields:
-                continue
-            try:
-                result[attr] = getattr(self, attr)
-            except:
-                result[attr] = getattr(self, attr.lower())
+        for attr, getter in plan.attributes:
+            if attr in fields:
+                result[attr] = getter(self)
         return result
 
+    @classmethod
+    def _s_get_plan(cls):
+        """
+            :return: the SerializationPlan of the class, it's created when the class is exposed
+            or when the first instance is serialized
+        """
+        # the plan of a superclass can't be used for subclasses, so check the class __dict__
+        plan = cls.__dict__.get("_s_serialization_plan")
+        if plan is None:
+            plan = SerializationPlan(cls)
+            cls._s_serialization_plan = plan
+        return plan
+
     @classmethod
     def _s_count(cls):
         """
             returning None will cause sqlalchemy to perform a count() on the result
             this can be overridden with a cached value for performance on large tables (>1G)
+            alternatively, the _s_count_strategy can be set (cfr. jsonapi.get_count)
         """
         return None
 
@@ -417,28 +543,18 @@ class SAFRSBase(Model):
                     }
         """
         relationships = dict()
-        excluded_csv = request.args.get("exclude", "")
-        excluded_list = excluded_csv.split(",")
-        included_csv = request.args.get("include", "")
-        included_list = included_csv.split(",")
-
+        plan = self._s_get_plan()
         # In order to request resources related to other resources,
         # a dot-separated path for each relationship name can be specified
-        nested_included_list = []
-        for inc in included_list:
-            if "." in inc:
-                nested_included_list += inc.split(".")
-        included_list += nested_included_list
-
-        # params = { self.object_id : self.id }
-        # obj_url = url_for(self.get_endpoint(), **params) # Doesn't work :(, todo : why?
-        obj_url = url_for(self.get_endpoint())
-        if obj_url.endswith("/"):
-            obj_url = obj_url[:-1]
-
-        self_link = self._s_url
-
-        for relationship in self.__mapper__.relationships:
+        included_list = request.included_relationships
+        # The relationships in the exclude= argument are skipped, unless they're included
+        excluded_list = request.excluded_relationships
+        # compact links: no resource and relationship links and no relationships without data
+        compact_links = request.compact_links
+        exclude_all = compact_links or request.exclude_all
+        self_link = None if compact_links else self._s_url
+
+        for relationship in plan.relationships:
             """
                 http://jsonapi.org/format/#document-resource-object-relationships:
 
@@ -463,28 +579,33 @@ class SAFRSBase(Model):
             """
             meta = {}
             rel_name = relationship.key
-            if rel_name in excluded_list:
-                # TODO: document this
-                # continue
-                pass
+            if rel_name not in included_list and (exclude_all or rel_name in excluded_list):
+                continue
             data = None
             if rel_name in included_list:
                 if relationship.direction == MANYTOONE:
-                    rel_item = getattr(self, rel_name)
-                    if rel_item:
-                        data = {
-                            "id": rel_item.jsonapi_id,
-                            "type": rel_item.__tablename__,
-                        }
+                    data = self._s_get_to_one_linkage(relationship)
                 elif relationship.direction in (ONETOMANY, MANYTOMANY):
                     # Data is optional, it's also really slow for large sets!!!!!
-                    rel_query = getattr(self, rel_name)
                     limit = request.page_limit
+                    # linkage fetched for all serialized instances, cfr. jsonapi.get_relationship_linkage
+                    linkage = getattr(request, "relationship_linkage", {}).get(relationship, {})
                     if not get_config("ENABLE_RELATIONSHIPS"):
                         meta[
                             "warning"
                         ] = "ENABLE_RELATIONSHIPS set to false in config.py"
-                    elif rel_query:
+                    elif self.jsonapi_id in linkage:
+                        count, data = linkage[self.jsonapi_id]
+                        meta["count"] = count
+                        meta["limit"] = limit
+                        if len(data) >= get_config("BIG_QUERY_THRESHOLD"):
+                            warning = 'Truncated result for relationship "{}",consider paginating this request'.format(
+                                rel_name
+                            )
+                            safrs.log.warning(warning)
+                            meta["warning"] = warning
+                    elif getattr(self, rel_name):
+                        rel_query = getattr(self, rel_name)
                         # todo: chekc if lazy=dynamic
                         # In order to work with the relationship as with Query,
                         # you need to configure it with lazy='dynamic'
@@ -517,9 +638,13 @@ class SAFRSBase(Model):
                 if safrs.log.getEffectiveLevel() < logging.INFO:
                     meta["direction"] = relationship.direction.name
 
-            rel_link = urljoin(self_link, rel_name)
-            links = dict(self=rel_link)
-            rel_data = dict(links=links)
+            if compact_links:
+                rel_data = dict()
+            elif self_link.endswith("/"):
+                # the relationship names are identifiers, so this is what urljoin would return
+                rel_data = dict(links=dict(self=self_link + rel_name))
+            else:
+                rel_data = dict(links=dict(self=urljoin(self_link, rel_name)))
 
             rel_data["data"] = data
             if meta:
@@ -527,25 +652,77 @@ class SAFRSBase(Model):
             relationships[rel_name] = rel_data
 
         attributes = self.to_dict()
-        # extract the required fieldnames from the request args, eg. Users/?Users[name] => [name]
-        fields = request.args.get("fields[{}]".format(self._s_type), None)
-        if fields:
+        # extract the required fieldnames from the request args, eg. Users/?fields[Users]=name => {name}
+        fields = request.fields.get(plan.type, None)
+        if fields is not None:
             # Remove all attributes not listed in the fields csv
-            fields = fields.split(",")
-            unwanted = set(attributes.keys()) - set(fields)
-            for unwanted_key in unwanted:
+            # (to_dict may have been overridden)
+            for unwanted_key in set(attributes.keys()) - fields:
                 attributes.pop(unwanted_key, None)
 
         data = dict(
             attributes=attributes,
             id=self.jsonapi_id,
-            links={"self": self_link},
-            type=self._s_type,
+            type=plan.type,
             relationships=relationships,
         )
+        if not compact_links:
+            data["links"] = {"self": self_link}
 
         return data
 
+    def _s_get_to_one_linkage(self, relationship):
+        """
+            Create the resource linkage of a MANYTOONE relationship.
+            When the related item isn't loaded, the linkage is built from the
+            local foreign key values so the related row doesn't have to be queried
+            :param relationship: MANYTOONE relationship
+            :return: linkage dict or None
+        """
+        rel_name = relationship.key
+        target = relationship.mapper.class_
+        fk_values = None
+        if (
+            rel_name not in sqla_inspect(self).dict
+            and relationship.secondary is None
+            and issubclass(target, SAFRSBase)
+        ):
+            fk_values = self._s_get_fk_values(relationship)
+
+        if fk_values is None:
+            rel_item = getattr(self, rel_name)
+            if not rel_item:
+                return None
+            return {"id": rel_item.jsonapi_id, "type": rel_item.__tablename__}
+
+        if None in fk_values:
+            return None
+        return {
+            "id": target.id_type.get_id_from_values(fk_values),
+            "type": target.__tablename__,
+        }
+
+    def _s_get_fk_values(self, relationship):
+        """
+            Retrieve the local foreign key values that reference the primary key of the related item
+            :param relationship: MANYTOONE relationship
+            :return: list of values, ordered like the target id_type columns,
+                     or None if the foreign keys don't cover the target primary key
+        """
+        target = relationship.mapper.class_
+        remote_local = {remote: local for local, remote in relationship.local_remote_pairs}
+        result = []
+        for pk_col in target.id_type.columns:
+            local_col = remote_local.get(pk_col)
+            if local_col is None:
+                return None
+            try:
+                prop = self.__mapper__.get_property_by_column(local_col)
+            except orm.exc.UnmappedColumnError:
+                return None
+            result.append(getattr(self, prop.key))
+        return result
+
     def __iter__(self):
         return iter(self.to_dict())
 
@@ -751,9 +928,14 @@ class SAFRSBase(Model):
             :return: endpoint url of this instance
         """
         try:
-            params = {self.object_id: self.jsonapi_id}
-            instance_url = url_for(self.get_endpoint(type="instance"), **params)
-            result = urljoin(request.url_root, instance_url)
+            template = self._s_get_url_template()
+            if template is None:
+                params = {self.object_id: self.jsonapi_id}
+                instance_url = url_for(self.get_endpoint(type="instance"), **params)
+                result = urljoin(request.url_root, instance_url)
+            else:
+                prefix, suffix = template
+                result = prefix + url_quote(self.jsonapi_id) + suffix
         except RuntimeError:
             # This happens when creating the swagger doc and there is no application registered
             result = ""
@@ -769,6 +951,31 @@ class SAFRSBase(Model):
             result = ""
         return result
 
+    @classmethod
+    def _s_get_url_template(cls):
+        """
+            The instance urls only differ in the id, so the url is built once per
+            url root with a placeholder id instead of calling url_for for every instance
+            :return: (prefix, suffix) tuple, the instance url is prefix + quoted id + suffix
+                     or None if the url can't be built like this
+        """
+        url_templates = cls._s_get_plan().url_templates
+        key = (current_app.url_map, request.url_root)
+        try:
+            template = url_templates[key]
+            url_templates.move_to_end(key)
+        except KeyError:
+            # not cached (or evicted by another thread)
+            params = {cls.object_id: URL_ID_MARKER}
+            instance_url = url_for(cls.get_endpoint(type="instance"), **params)
+            instance_url = urljoin(request.url_root, instance_url)
+            prefix, marker, suffix = instance_url.partition(URL_ID_MARKER)
+            template = (prefix, suffix) if marker else None
+            url_templates[key] = template
+            while len(url_templates) > URL_TEMPLATES_SIZE:
+                url_templates.popitem(last=False)
+        return template
+
     @classmethod
     def _s_meta(cls):
         """
@@ -1,14 +1,48 @@
 """
 safrs to json encoding
 """
+import base64
 import datetime
+import enum
 import logging
 import decimal
 import json
+import re
+import uuid
+from flask import current_app, request
 from flask.json import JSONEncoder
 from sqlalchemy.ext.declarative import DeclarativeMeta
 import safrs
 from .db import SAFRSBase, SAFRSDummy
+from .config import get_config
+from .columnar import JSON_MIMETYPES
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = "application/vnd.api+msgpack"
+
+NON_ASCII_RE = re.compile("[^\\x00-\\x7e]")
+NON_ASCII_BYTES_RE = re.compile(b"[^\\x00-\\x7e]")
+
+
+def escape_non_ascii(match):
+    """
+        Escape a non-ascii character like the stdlib encoder (json.encoder.py_encode_basestring_ascii)
+    """
+    code = ord(match.group(0))
+    if code < 0x10000:
+        return "\\u{0:04x}".format(code)
+    code -= 0x10000
+    return "\\u{0:04x}\\u{1:04x}".format(0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+
 
 class SAFRSFormattedResponse:
     """
@@ -36,6 +70,27 @@ class SAFRSFormattedResponse:
             
         return None
 
+
+# Conversion of the non-json types, cfr. SAFRSJSONEncoder.default:
+# the converter of a type is looked up in its mro, the lookups are cached in CONVERTER_CACHE.
+# The other types are converted by SAFRSJSONEncoder.convert_unknown
+CONVERTER_CACHE = {}
+FAST_CONVERTERS = {
+    SAFRSBase: lambda encoder, obj: encoder.convert_document(obj),
+    SAFRSFormattedResponse: lambda encoder, obj: obj.to_dict(),
+    SAFRSDummy: lambda encoder, obj: {},
+    datetime.datetime: lambda encoder, obj: obj.isoformat(" "),
+    datetime.date: lambda encoder, obj: obj.isoformat(),
+    datetime.time: lambda encoder, obj: obj.isoformat(),
+    decimal.Decimal: lambda encoder, obj: str(obj),
+    set: lambda encoder, obj: list(obj),
+    frozenset: lambda encoder, obj: list(obj),
+    bytes: lambda encoder, obj: base64.b64encode(obj).decode("ascii"),
+    uuid.UUID: lambda encoder, obj: str(obj),
+    enum.Enum: lambda encoder, obj: obj.value,
+}
+
+
 class SAFRSJSONEncoder(JSONEncoder):
     """
         Encodes safrs objs (SAFRSBase subclasses)
@@ -47,38 +102,109 @@ class SAFRSJSONEncoder(JSONEncoder):
             :param obj: object to be encoded
             :return: encoded/serizlaized object
         """
-        if isinstance(obj, SAFRSBase):
-            result = obj._s_jsonapi_encode()
-            return result
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat(" ")
-        if isinstance(obj, datetime.date):
-            return obj.isoformat()
-        if isinstance(obj, SAFRSDummy):
-            return {}
+        converter = CONVERTER_CACHE.get(type(obj))
+        if converter is None:
+            converter = self.get_converter(type(obj))
+        return converter(self, obj)
+
+    def convert_unknown(self, obj):
+        """
+            Encode an object that doesn't have a converter in FAST_CONVERTERS
+            :param obj: object to be encoded
+            :return: encoded/serizlaized object
+        """
         # We shouldn't get here in a normal setup
         # getting here means we already abused safrs... and we're no longer jsonapi compliant
         if safrs.log.getEffectiveLevel() >= logging.INFO:
             # only continue if in debug mode
             safrs.log.warning('Unknown obj type "{}" for {}'.format(type(obj), obj))
             return {"error": "invalid object"}
-        if isinstance(obj, set):
-            return list(obj)
         if isinstance(obj, DeclarativeMeta):
             return self.sqla_encode(obj)
-        if isinstance(obj, SAFRSFormattedResponse):
-            return obj.to_dict()
-        if isinstance(obj, SAFRSFormattedResponse):
-            return obj.to_dict()
-        if isinstance(obj, decimal.Decimal):
-            return str(obj)
-        if isinstance(obj, bytes):
-            safrs.log.warning("bytes obj, TODO")
-
-        else:
-            safrs.log.warning('Unknown obj type "{}" for {}'.format(type(obj), obj))
+
+        safrs.log.warning('Unknown obj type "{}" for {}'.format(type(obj), obj))
         return self.ghetto_encode(obj)
 
+    def encode(self, o):
+        """
+            Encode o to a json string.
+            When FAST_JSON_ENCODER is enabled and orjson is installed, o is serialized by orjson:
+            orjson serializes the json types and calls self.default for the other types.
+            The stdlib encoder is used when orjson can't serialize o (e.g. non-str keys)
+            or when the output would differ: orjson formats some floats differently
+            (e.g. 0.00001 instead of 1e-05 and null instead of NaN), these are looked up
+            in the attributes of the SAFRSBase instances
+            :param o: object to encode
+            :return: json string
+        """
+        if (
+            orjson is None
+            or self.indent is not None
+            or self.item_separator != ","
+            or self.key_separator != ":"
+            or not get_config("FAST_JSON_ENCODER")
+            or type(self).default is not SAFRSJSONEncoder.default
+        ):
+            return super().encode(o)
+
+        self.orjson_compatible = True
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            result = orjson.dumps(o, default=self.default, option=option)
+        except TypeError:
+            # orjson.JSONEncodeError is a TypeError: non-str keys, large ints, ...
+            # let the stdlib encoder handle (or raise) these
+            self.orjson_compatible = False
+
+        if not self.orjson_compatible:
+            return super().encode(o)
+
+        if self.ensure_ascii and NON_ASCII_BYTES_RE.search(result):
+            # orjson doesn't escape DEL and non-ascii characters
+            return NON_ASCII_RE.sub(escape_non_ascii, result.decode("utf-8"))
+        return result.decode("utf-8")
+
+    def convert_document(self, instance):
+        """
+            Create the jsonapi document of instance
+            :param instance: SAFRSBase instance
+            :return: jsonapi document
+        """
+        document = instance._s_jsonapi_encode()
+        attributes = document.get("attributes") if isinstance(document, dict) else None
+        for value in (attributes or {}).values():
+            # cfr. encode: orjson formats these floats differently
+            if type(value) is float and not (value == 0 or 1e-4 <= abs(value) < 1e16):
+                self.orjson_compatible = False
+        return document
+
+    def convert(self, obj):
+        """
+            Convert an object that isn't a json type, e.g. for msgpack
+            :param obj: object to convert
+            :return: converted object
+        """
+        return self.default(obj)
+
+    @staticmethod
+    def get_converter(obj_type):
+        """
+            :param obj_type: type of the object to convert
+            :return: conversion function for obj_type
+        """
+        converter = CONVERTER_CACHE.get(obj_type)
+        if converter is None:
+            for base in obj_type.__mro__:
+                if base in FAST_CONVERTERS:
+                    converter = FAST_CONVERTERS[base]
+                    break
+            else:
+                converter = lambda encoder, obj: encoder.convert_unknown(obj)
+            CONVERTER_CACHE[obj_type] = converter
+        return converter
+
     @staticmethod
     def ghetto_encode(obj):
         """
@@ -117,3 +243,36 @@ class SAFRSJSONEncoder(JSONEncoder):
 
         # a json-encodable dict
         return fields
+
+
+def msgpack_requested():
+    """
+        :return: True if the client prefers msgpack over json (cfr. the Accept header)
+    """
+    if msgpack is None:
+        return False
+    best_match = request.accept_mimetypes.best_match(JSON_MIMETYPES + [MSGPACK_MIMETYPE])
+    return best_match == MSGPACK_MIMETYPE
+
+
+def output_msgpack(data, code, headers=None):
+    """
+        MessagePack representation of the response data.
+        The document is the same as the json document: the objects that
+        aren't msgpack types are converted by the app json encoder
+        :param data: response data, e.g. the result of jsonapi_format_response
+        :param code: http status code
+        :param headers: response headers
+        :return: flask response
+    """
+    encoder = current_app.json_encoder()
+    body = msgpack.packb(data, default=encoder.convert, use_bin_type=True)
+    response = current_app.response_class(body, status=code, mimetype=MSGPACK_MIMETYPE)
+    response.headers.extend(headers or {})
+    return response
+
+
+# Registered in Api.representations, cfr. _api.DEFAULT_REPRESENTATIONS
+MSGPACK_REPRESENTATIONS = []
+if msgpack is not None:
+    MSGPACK_REPRESENTATIONS.append((MSGPACK_MIMETYPE, output_msgpack))
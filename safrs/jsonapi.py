@@ -18,24 +18,46 @@
 #
 import logging
 import re
+import json
+import base64
+import decimal
+import datetime
+import hashlib
 import sqlalchemy
 import sqlalchemy.orm.dynamic
 import sqlalchemy.orm.collections
-from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY, MANYTOMANY
 from flask import make_response, url_for
 from flask import jsonify, request
+from flask import current_app, stream_with_context
+from flask import json as flask_json
 from flask_restful.utils import cors
 from flask_restful_swagger_2 import Resource
 import safrs
-from .db import SAFRSBase
+from .db import SAFRSBase, IN_CHUNK_SIZE
 from .swagger_doc import is_public
 from .errors import ValidationError, GenericError, NotFoundError
 from .config import get_config
-from .json_encoder import SAFRSFormattedResponse
+from .json_encoder import SAFRSFormattedResponse, msgpack_requested, output_msgpack
+from .columnar import ColumnarPage, get_columnar_mimetype
+from .cache import cached_response, get_session_tables, not_modified_response, set_validators
 from urllib.parse import urlparse
 
 INCLUDE_ALL = "+all"
 
+# Count strategies, cfr. get_count
+COUNT_EXACT = "exact"
+COUNT_ESTIMATED = "estimated"
+COUNT_CAPPED = "capped"
+COUNT_NONE = "none"
+COUNT_CUSTOM = "custom"  # SAFRSBase._s_count override
+COUNT_STRATEGIES = (COUNT_EXACT, COUNT_ESTIMATED, COUNT_CAPPED, COUNT_NONE)
+
+# Number of rows fetched at once when streaming a response,
+# cfr. jsonapi_stream_response and jsonapi_ndjson_response
+STREAM_BATCH_SIZE = 100
+
 
 def get_legacy(param, default=0):
     """
@@ -53,33 +75,104 @@ def get_legacy(param, default=0):
         result = default
     return result
 
-# results for GET requests will go through filter -> sort -> paginate
-def jsonapi_filter(safrs_object):
+# Operators that can be used with filter[column][operator]=value
+FILTER_OPERATORS = {
+    "eq": lambda column, value: column == value,
+    "ne": lambda column, value: column != value,
+    "gt": lambda column, value: column > value,
+    "ge": lambda column, value: column >= value,
+    "lt": lambda column, value: column < value,
+    "le": lambda column, value: column <= value,
+    "like": lambda column, value: column.like(value),
+    "in": lambda column, values: column.in_(values),
+    "null": lambda column, is_null: column.is_(None) if is_null else column.isnot(None),
+}
+
+
+# results for GET requests will go through filter -> sort -> eager load -> paginate
+def jsonapi_filter(safrs_object, object_query=None):
     """
         Apply the request.args filters to the object
+        All filter[] arguments are combined into a single WHERE clause (AND):
+        - filter[col]=a,b : col IN (a, b)
+        - filter[col][operator]=value : cfr. FILTER_OPERATORS, e.g.
+          filter[age][gt]=18, filter[name][like]=a%, filter[email][null]=false
+
         :parameter safrs_object:
+        :parameter object_query: query to filter, e.g. the items of a relationship,
+                                 by default all safrs_object items are filtered
         :return: a sqla query object
     """
-    
+
     # First check if a filter= URL query parameter has been used
     filter_args = get_legacy('filter')
     if filter_args:
         result = safrs_object._s_filter(filter_args)
+        if object_query is not None and object_query.whereclause is not None:
+            result = result.filter(object_query.whereclause)
         return result
-    
-    filtered = []
+
+    expressions = []
     filters = get_legacy("filters", {})
     for col_name, val in filters.items():
         if not col_name in safrs_object._s_column_names:
             safrs.log.warning("Invalid Column {}".format(col_name))
             continue
         column = getattr(safrs_object, col_name)
-        filtered.append(safrs_object.query.filter(column.in_(val.split(","))))
+        values = [parse_column_value(safrs_object, col_name, v) for v in val.split(",")]
+        expressions.append(column.in_(values))
+
+    for col_name, operator, val in getattr(request, "filter_operators", []):
+        if not col_name in safrs_object._s_column_names:
+            safrs.log.warning("Invalid Column {}".format(col_name))
+            continue
+        if operator not in FILTER_OPERATORS:
+            raise ValidationError('Invalid filter operator "{}"'.format(operator))
+        column = getattr(safrs_object, col_name)
+        if operator == "null":
+            value = val.lower() not in ("false", "0")
+        elif operator == "in":
+            value = [parse_column_value(safrs_object, col_name, v) for v in val.split(",")]
+        elif operator == "like":
+            value = val
+        else:
+            value = parse_column_value(safrs_object, col_name, val)
+        expressions.append(FILTER_OPERATORS[operator](column, value))
+
+    result = safrs_object.query if object_query is None else object_query
+    if expressions:
+        result = result.filter(*expressions)
+
+    return result
 
-    if filtered:
-        result = filtered[0].union_all(*filtered).distinct()
-    else:
-        result = safrs_object.query
+
+def get_sort_columns(safrs_object):
+    """
+        http://jsonapi.org/format/#fetching-sorting
+        parse the csv sort= values, a "-" prefix means descending order.
+        Only the columns can be sorted: invalid sort columns are ignored,
+        unless cursor pagination is requested (the cursor contains the column values)
+        :param safrs_object: SAFRSBase subclass
+        :return: list of (attribute name, descending) tuples
+    """
+    result = []
+    sort_columns = request.args.get("sort", None)
+    if sort_columns is None:
+        return result
+
+    keyset_pagination = (
+        getattr(request, "page_after", None) is not None
+        or getattr(request, "page_before", None) is not None
+    )
+    for sort_column in sort_columns.split(","):
+        descending = sort_column.startswith("-")
+        attr_name = sort_column[1:] if descending else sort_column
+        if attr_name not in safrs_object.__mapper__.columns:
+            if keyset_pagination:
+                raise ValidationError('Invalid sort column "{}"'.format(attr_name))
+            safrs.log.warning("Invalid sort column {}".format(attr_name))
+            continue
+        result.append((attr_name, descending))
 
     return result
 
@@ -89,20 +182,328 @@ def jsonapi_sort(object_query, safrs_object):
         http://jsonapi.org/format/#fetching-sorting
         sort by csv sort= values
     """
-    sort_columns = request.args.get("sort", None)
-    if not sort_columns is None:
-        for sort_column in sort_columns.split(","):
-            if sort_column.startswith("-"):
-                attr = getattr(safrs_object, sort_column[1:], None).desc()
-                object_query = object_query.order_by(attr)
-            else:
-                attr = getattr(safrs_object, sort_column, None)
-                object_query = object_query.order_by(attr)
+    for attr_name, descending in get_sort_columns(safrs_object):
+        attr = getattr(safrs_object, attr_name)
+        object_query = object_query.order_by(attr.desc() if descending else attr)
 
     return object_query
 
 
-def paginate(object_query, SAFRSObject=None):
+def get_keyset(safrs_object):
+    """
+        The keyset determines the row order used for cursor pagination:
+        the requested sort columns followed by the primary keys,
+        so every row has a unique position in the result
+        :param safrs_object: SAFRSBase subclass
+        :return: list of (attribute name, descending) tuples
+    """
+    keyset = get_sort_columns(safrs_object)
+    sort_names = [attr_name for attr_name, descending in keyset]
+    for pk_col in safrs_object.id_type.columns:
+        if pk_col.name not in sort_names:
+            keyset.append((pk_col.name, False))
+    return keyset
+
+
+def encode_cursor(instance, keyset):
+    """
+        Create an opaque page[after]/page[before] token from the keyset values of instance
+        :param instance: SAFRSBase instance
+        :param keyset: cfr. get_keyset
+        :return: urlsafe base64 string
+    """
+    values = []
+    for attr_name, descending in keyset:
+        value = getattr(instance, attr_name)
+        if isinstance(value, (datetime.date, decimal.Decimal)):
+            value = str(value)
+        values.append(value)
+    sort = ",".join(("-" if desc else "") + attr_name for attr_name, desc in keyset)
+    cursor = json.dumps({"s": sort, "v": values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(cursor.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(safrs_object, keyset, token):
+    """
+        Parse a page[after]/page[before] token created by encode_cursor
+        :param safrs_object: SAFRSBase subclass
+        :param keyset: cfr. get_keyset, this should be the keyset used to create the token
+        :param token: the cursor token
+        :return: list of keyset values
+    """
+    sort = ",".join(("-" if desc else "") + attr_name for attr_name, desc in keyset)
+    try:
+        padding = "=" * (-len(token) % 4)
+        cursor = json.loads(base64.urlsafe_b64decode(token + padding).decode("utf-8"))
+        values = cursor["v"]
+        if cursor["s"] != sort or len(values) != len(keyset):
+            raise ValueError("cursor doesn't match the sort order")
+        return [
+            parse_column_value(safrs_object, attr_name, value)
+            for (attr_name, descending), value in zip(keyset, values)
+        ]
+    except (ValueError, TypeError, KeyError) as exc:
+        raise ValidationError("Invalid page cursor ({})".format(exc))
+
+
+def parse_column_value(safrs_object, attr_name, value):
+    """
+        Convert a request argument or json cursor value to the python type of the column
+        :param safrs_object: SAFRSBase subclass
+        :param attr_name: column attribute name
+        :param value: value to convert
+        :return: converted value
+    """
+    column = safrs_object.__mapper__.columns.get(attr_name)
+    if value is None or column is None:
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    try:
+        # ISO 8601 values, a date (e.g. 2020-01-01) is also accepted for a datetime column
+        if python_type == datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+        if python_type == datetime.date:
+            return datetime.date.fromisoformat(value)
+        if python_type == datetime.time:
+            return datetime.time.fromisoformat(value)
+        if python_type == bool and isinstance(value, str):
+            return value.lower() not in ("false", "0")
+        return python_type(value)
+    except (ValueError, TypeError, decimal.InvalidOperation):
+        raise ValidationError('Invalid value for "{}"'.format(attr_name))
+
+
+def get_keyset_terms(safrs_object, keyset, values=None):
+    """
+        Create the sort expressions of the keyset: a nullable column is preceded by
+        a "column IS NULL" expression, so the NULL values are sorted after the other
+        values (before them in descending order) regardless of the db
+        and the rows with NULL values can be selected by the seek predicate
+        :param safrs_object: SAFRSBase subclass
+        :param keyset: cfr. get_keyset
+        :param values: cursor values, cfr. decode_cursor
+        :return: list of (sqla expression, descending, value) tuples
+    """
+    if values is None:
+        values = [None] * len(keyset)
+    result = []
+    for (attr_name, descending), value in zip(keyset, values):
+        attr = getattr(safrs_object, attr_name)
+        if safrs_object.__mapper__.columns[attr_name].nullable:
+            is_null = sqlalchemy.case([(attr.is_(None), 1)], else_=0)
+            result.append((is_null, descending, int(value is None)))
+        result.append((attr, descending, value))
+    return result
+
+
+def keyset_predicate(safrs_object, keyset, values, reverse=False):
+    """
+        Create the seek predicate that selects the rows following the cursor values:
+        WHERE (sort_cols) > (values)
+        If the sort directions differ or a cursor value is NULL, the row value comparison
+        is expanded to a > x OR (a = x AND b < y) ...
+        :param reverse: select the rows preceding the cursor values
+        :return: sqla expression
+    """
+    terms = get_keyset_terms(safrs_object, keyset, values)
+    # lower[i] is True if the i'th term value has to be lower than the cursor value
+    lower = [descending != reverse for expr, descending, value in terms]
+
+    if len(set(lower)) == 1 and None not in values:
+        if len(terms) == 1:
+            left, right = terms[0][0], terms[0][2]
+        else:
+            left = sqlalchemy.tuple_(*[expr for expr, descending, value in terms])
+            right = tuple(value for expr, descending, value in terms)
+        return left < right if lower[0] else left > right
+
+    clauses = []
+    for i, (expr, descending, value) in enumerate(terms):
+        if value is None:
+            # the NULL values are equal, they're ordered by the next terms
+            continue
+        clause = [prev.is_(None) if val is None else prev == val for prev, desc, val in terms[:i]]
+        clause.append(expr < value if lower[i] else expr > value)
+        clauses.append(sqlalchemy.and_(*clause))
+    return sqlalchemy.or_(*clauses)
+
+
+def get_page_link(*page_args):
+    """
+        Create a pagination link: the request url with the page[...] arguments
+        replaced by page_args, page[count] is kept
+        :param page_args: (page argument, value) tuples, e.g. ("page[offset]", 0), ("page[limit]", 10)
+        :return: url
+    """
+    args = [
+        "{}={}".format(k, v)
+        for k, v in request.args.items()
+        if not k.startswith("page[") or k == "page[count]"
+    ]
+    args += ["{}={}".format(k, v) for k, v in page_args]
+    return request.base_url + "?" + "&".join(args)
+
+
+def paginate_keyset(object_query, SAFRSObject, limit, stream=False):
+    """
+        Cursor pagination: page[after] and page[before] contain the keyset values
+        of the last and first row of the adjacent page, as generated by encode_cursor.
+        The page is retrieved with a seek predicate instead of an offset,
+        so the cost of retrieving a page doesn't depend on its depth.
+
+        - page[after]= (empty) returns the first page
+        - page[before]= (empty) returns the last page
+
+        :parameter object_query: SQLAalchemy query object
+        :parameter SAFRSObject: SAFRSBase subclass
+        :parameter limit: page limit
+        :parameter stream: return the instances as a generator, cfr. paginate
+        :return: links, instances
+    """
+
+    def get_link(cursor_arg, token):
+        # the links of a relationship collection contain the relationship url
+        return get_page_link((cursor_arg, token), ("page[limit]", limit))
+
+    page_after = getattr(request, "page_after", None)
+    page_before = getattr(request, "page_before", None)
+    # page[before] seeks backwards: reverse the order and the results
+    reverse = page_after is None
+    token = page_before if reverse else page_after
+
+    keyset = get_keyset(SAFRSObject)
+    object_query = object_query.order_by(None)
+    for expr, descending, value in get_keyset_terms(SAFRSObject, keyset):
+        object_query = object_query.order_by(
+            expr.desc() if descending != reverse else expr
+        )
+    if token:
+        values = decode_cursor(SAFRSObject, keyset, token)
+        object_query = object_query.filter(
+            keyset_predicate(SAFRSObject, keyset, values, reverse)
+        )
+
+    def set_links(first, last, has_more):
+        if reverse:
+            first, last = last, first
+            has_next, has_prev = bool(token), has_more
+        else:
+            has_next, has_prev = has_more, bool(token)
+        if has_prev and first is not None:
+            links["first"] = get_link("page[after]", "")
+            links["prev"] = get_link("page[before]", encode_cursor(first, keyset))
+        if has_next and last is not None:
+            links["last"] = get_link("page[before]", "")
+            links["next"] = get_link("page[after]", encode_cursor(last, keyset))
+
+    links = {"self": request.url}
+    # fetch one extra row to find out whether there's another page
+    # page[before] results have to be reversed, so they can't be streamed
+    instances = iter_page(object_query.limit(limit + 1), limit, set_links, stream and not reverse)
+    if reverse:
+        instances = list(reversed(list(instances)))
+    elif not stream:
+        instances = list(instances)
+
+    return links, instances
+
+
+def jsonapi_eager_load(object_query, safrs_object):
+    """
+        Eager load the relationships requested with the include= argument:
+        the relationships in the include tree (cfr. SAFRSRequest.include_tree)
+        are loaded with a constant number of queries, regardless of the page size,
+        instead of lazy loading them for every instance.
+        Sparse fieldsets (fields[type]=...) limit the columns that are loaded
+        :param object_query: SQLAalchemy query object
+        :param safrs_object: SAFRSBase subclass
+        :return: the query with the loader options
+    """
+    include_tree = getattr(request, "include_tree", {})
+    options = get_loader_options(safrs_object, include_tree)
+    # the sort columns are needed to create the page cursors
+    sort_names = [name.lstrip("-") for name in request.args.get("sort", "").split(",")]
+    load_only_attrs = get_load_only_attrs(safrs_object, include_tree, sort_names)
+    if load_only_attrs is not None:
+        options.append(sqlalchemy.orm.load_only(*load_only_attrs))
+    if options:
+        object_query = object_query.options(*options)
+    return object_query
+
+
+def get_loader_options(safrs_object, include_tree, parent_loader=None):
+    """
+        Create the sqla loader options for the relationships in the include tree:
+        - MANYTOONE relationships are loaded with a join
+        - to-many relationships are loaded with a "SELECT .. IN" query
+        lazy="dynamic" relationships can't be eager loaded, they're queried when serialized
+        :param safrs_object: SAFRSBase subclass
+        :param include_tree: dict of relationship names to nested trees
+        :param parent_loader: loader option of the relationship path that leads to safrs_object
+        :return: list of loader options
+    """
+    result = []
+    relationships = safrs_object.__mapper__.relationships
+    if INCLUDE_ALL in include_tree:
+        include_tree = dict(include_tree)
+        for relationship in relationships:
+            include_tree.setdefault(relationship.key, {})
+
+    for rel_name, nested_tree in include_tree.items():
+        relationship = relationships.get(rel_name)
+        if relationship is None or relationship.lazy == "dynamic":
+            continue
+        attr = getattr(safrs_object, rel_name)
+        if parent_loader is None:
+            loader = joinedload(attr) if relationship.direction == MANYTOONE else selectinload(attr)
+        elif relationship.direction == MANYTOONE:
+            loader = parent_loader.joinedload(attr)
+        else:
+            loader = parent_loader.selectinload(attr)
+        result.append(loader)
+        target = relationship.mapper.class_
+        load_only_attrs = get_load_only_attrs(target, nested_tree)
+        if load_only_attrs is not None:
+            result.append(loader.load_only(*load_only_attrs))
+        result += get_loader_options(target, nested_tree, loader)
+
+    return result
+
+
+def get_load_only_attrs(safrs_object, include_tree, extra_names=()):
+    """
+        https://jsonapi.org/format/#fetching-sparse-fieldsets
+        Translate the fields[type] argument to the column attributes that will be loaded:
+        the requested fields, the primary keys and the local columns of the included
+        relationships, which are needed to create the ids and the relationship linkage
+        :param safrs_object: SAFRSBase subclass
+        :param include_tree: included relationships of safrs_object
+        :param extra_names: other column names that have to be loaded
+        :return: list of attribute names or None if all columns should be loaded
+    """
+    fields = getattr(request, "fields", {}).get(safrs_object._s_type)
+    if fields is None or not issubclass(safrs_object, SAFRSBase):
+        return None
+
+    # "type" is exposed as "Type", cfr. SAFRSBase._s_jsonapi_attrs
+    names = {"type" if field == "Type" else field for field in fields}
+    names.update(extra_names)
+    columns = set(safrs_object.id_type.columns)
+    for relationship in safrs_object.__mapper__.relationships:
+        if relationship.key in include_tree or INCLUDE_ALL in include_tree:
+            columns.update(relationship.local_columns)
+
+    result = []
+    for prop in safrs_object.__mapper__.column_attrs:
+        if prop.key in names or prop.columns[0].name in names or prop.columns[0] in columns:
+            result.append(prop.key)
+    return result
+
+
+def paginate(object_query, SAFRSObject=None, stream=False):
     """
         http://jsonapi.org/format/#fetching-pagination
 
@@ -123,38 +524,57 @@ def paginate(object_query, SAFRSObject=None):
         next: the next page of data
 
         We use page[offset] and page[limit], where
-        offset is the number of records to offset by prior to returning resources
+        offset is the number of records to offset by prior to returning resources.
+        Alternatively, page[after] and page[before] cursors can be used
+        instead of page[offset], cfr. paginate_keyset
 
         :parameter object_query: SQLAalchemy query object
         :prameter SAFRSObject: optional
+        :parameter stream: return the instances as a generator that fetches the rows in batches,
+                           the links may only be complete after the generator has been consumed
         :return: links, instances, count
     """
 
     def get_link(count, limit):
-        result = SAFRSObject._s_url if SAFRSObject else ""
-        result += "?" + "&".join(
-            ["{}={}".format(k, v) for k, v in request.args.items()]
-            + ["page[offset]={}&page[limit]={}".format(count, limit)]
-        )
-        return result
+        return get_page_link(("page[offset]", count), ("page[limit]", limit))
 
     page_offset = get_legacy("page_offset")
     limit = get_legacy("page_limit", get_config("MAX_PAGE_LIMIT"))
     page_base = int(page_offset / limit) * limit
 
+    keyset_pagination = (
+        getattr(request, "page_after", None) is not None
+        or getattr(request, "page_before", None) is not None
+    )
     # Counting may take > 1s for a table with millions of records, depending on the storage engine :|
-    # Make it configurable
-    # With mysql innodb we can use following to retrieve the count:
-    # select TABLE_ROWS from information_schema.TABLES where TABLE_NAME = 'TableName';
-    #
-    if (
-        SAFRSObject is None
-    ):  # for backwards compatibility, ie. when not passed as an arg to paginate()
-        count = object_query.count()
+    # the count strategy is configurable, cfr. get_count
+    # cursor pages aren't counted, unless the count is requested with page[count]=true
+    if keyset_pagination and not getattr(request, "page_count", None):
+        count, count_strategy = None, COUNT_NONE
     else:
-        count = SAFRSObject._s_count()
-    if count is None:
-        count = object_query.count()
+        count, count_strategy = get_count(object_query, SAFRSObject)
+    request.count_strategy = count_strategy
+
+    if keyset_pagination:
+        if SAFRSObject is None:
+            SAFRSObject = object_query.column_descriptions[0]["entity"]
+        links, instances = paginate_keyset(object_query, SAFRSObject, limit, stream)
+        return links, instances, count
+
+    if count_strategy not in (COUNT_EXACT, COUNT_CUSTOM):
+        # The count is approximate or unknown: we can't link to the last page.
+        # Fetch one extra row to find out whether there's a next page
+        def set_next_link(first, last, has_more):
+            if has_more:
+                links["next"] = get_link(page_offset + limit, limit)
+
+        links = {"self": get_link(page_offset, limit)}
+        if page_offset > 0:
+            links["first"] = get_link(0, limit)
+            links["prev"] = get_link(max(page_offset - limit, 0), limit)
+        page_query = object_query.offset(page_offset).limit(limit + 1)
+        instances = iter_page(page_query, limit, set_next_link, stream)
+        return links, instances if stream else list(instances), count
 
     first_args = (0, limit)
     last_args = (int(int(count / limit) * limit), limit)  # round down
@@ -184,10 +604,222 @@ def paginate(object_query, SAFRSObject=None):
         del links["prev"]
 
     res_query = object_query.offset(page_offset).limit(limit)
+    if stream:
+        return links, iter_page(res_query, limit, stream=True), count
     instances = res_query.all()
     return links, instances, count
 
 
+def iter_page(page_query, limit, callback=None, stream=False):
+    """
+        Generate the instances of a page
+        :param page_query: query for the page rows, possibly with one extra row
+        :param limit: page limit, the extra row isn't returned
+        :param callback: called with the first and last instance and whether there was
+                         an extra row when all instances have been generated
+        :param stream: fetch the rows in batches of STREAM_BATCH_SIZE
+    """
+    if stream:
+        page_query = page_query.yield_per(STREAM_BATCH_SIZE)
+    first = last = None
+    has_more = False
+    for i, instance in enumerate(page_query):
+        if i == limit:
+            has_more = True
+            break
+        if first is None:
+            first = instance
+        last = instance
+        yield instance
+    if callback:
+        callback(first, last, has_more)
+
+
+def get_count_strategy(SAFRSObject=None):
+    """
+        The count strategy can be set for a SAFRSBase subclass with the _s_count_strategy
+        class attribute, the COUNT_STRATEGY config setting is used by default
+        :param SAFRSObject: SAFRSBase subclass
+        :return: one of COUNT_STRATEGIES
+    """
+    strategy = getattr(SAFRSObject, "_s_count_strategy", None)
+    if strategy is None:
+        strategy = get_config("COUNT_STRATEGY")
+    if strategy not in COUNT_STRATEGIES:
+        safrs.log.warning('Invalid count strategy "{}"'.format(strategy))
+        strategy = COUNT_EXACT
+    return strategy
+
+
+def get_count(object_query, SAFRSObject=None):
+    """
+        Count the items in the object_query according to the count strategy:
+        - exact: SELECT count(*)
+        - estimated: use the table statistics of the db, only for unfiltered queries
+        - capped: count at most COUNT_CAP items
+        - none: don't count, this is also the case when page[count]=false is requested
+
+        When the estimated strategy can't be applied we fall back to the capped
+        strategy, a capped count that didn't reach the cap is exact.
+        A count returned by the SAFRSObject._s_count() override is used regardless of the strategy
+
+        :param object_query: SQLAalchemy query object
+        :param SAFRSObject: SAFRSBase subclass
+        :return: count, strategy used to retrieve the count
+    """
+    if getattr(request, "page_count", True) is False:
+        return None, COUNT_NONE
+
+    if SAFRSObject is not None:
+        count = SAFRSObject._s_count()
+        if count is not None:
+            return count, COUNT_CUSTOM
+
+    strategy = get_count_strategy(SAFRSObject)
+    if strategy == COUNT_NONE:
+        return None, COUNT_NONE
+
+    if strategy == COUNT_ESTIMATED:
+        if SAFRSObject is None:
+            SAFRSObject = object_query.column_descriptions[0]["entity"]
+        count = estimate_count(object_query, SAFRSObject)
+        if count is not None:
+            return count, COUNT_ESTIMATED
+        strategy = COUNT_CAPPED
+
+    if strategy == COUNT_CAPPED:
+        cap = get_config("COUNT_CAP")
+        count = object_query.order_by(None).limit(cap + 1).count()
+        if count > cap:
+            return cap, COUNT_CAPPED
+        return count, COUNT_EXACT
+
+    return object_query.count(), COUNT_EXACT
+
+
+def estimate_count(object_query, SAFRSObject):
+    """
+        Retrieve the approximate number of rows from the table statistics.
+        This is only possible if the object_query selects the whole table
+        :param object_query: SQLAalchemy query object
+        :param SAFRSObject: SAFRSBase subclass
+        :return: estimated number of rows or None if no estimate is available
+    """
+    table = SAFRSObject.__table__
+    if object_query.whereclause is not None or list(
+        object_query.statement.froms
+    ) != [table]:
+        return None
+
+    session = object_query.session
+    dialect = session.get_bind(SAFRSObject.__mapper__).dialect.name
+    if dialect not in ("sqlite", "mysql", "postgresql"):
+        return None
+    params = {"table": table.name, "schema": table.schema}
+    try:
+        # the statistics may not be accessible, the savepoint is rolled back on failure
+        # so the transaction can still be used (postgres aborts it when a statement fails)
+        with session.begin_nested():
+            if dialect == "sqlite":
+                # the first integer of the stat column is the approximate number of rows,
+                # sqlite_stat1 is populated by ANALYZE
+                rows = session.execute(
+                    sqlalchemy.text("SELECT stat FROM sqlite_stat1 WHERE tbl = :table"),
+                    params,
+                )
+                counts = [int(row[0].split()[0]) for row in rows if row[0]]
+                return max(counts) if counts else None
+            if dialect == "mysql":
+                count = session.execute(
+                    sqlalchemy.text(
+                        "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                        "WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) AND TABLE_NAME = :table"
+                    ),
+                    params,
+                ).scalar()
+            else:
+                count = session.execute(
+                    sqlalchemy.text(
+                        "SELECT c.reltuples FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                        "WHERE c.relname = :table AND n.nspname = COALESCE(:schema, current_schema())"
+                    ),
+                    params,
+                ).scalar()
+    except sqlalchemy.exc.SQLAlchemyError as exc:
+        safrs.log.info("Failed to estimate the count for {}: {}".format(table.name, exc))
+        return None
+
+    if count is None or count < 0:
+        # postgres reltuples is -1 if the table hasn't been analyzed
+        return None
+    return int(count)
+
+
+def get_validators(safrs_object, object_query, *key, instance=False):
+    """
+        Compute the validators of a GET response for conditional requests (RFC 7232)
+        without retrieving the rows: the ETag is a hash of the request and a fingerprint of
+        the rows in object_query, i.e. the row count and
+        - the sum of the version column, if the model declares one (mapper version_id_col)
+        - the max of the safrs_object._s_modified_column, this is also the Last-Modified date
+
+        The related resources aren't part of the fingerprint, so there are no validators
+        for requests with included resources
+        :param safrs_object: SAFRSBase subclass
+        :param object_query: query of the rows in the response
+        :param key: other values the response depends on
+        :param instance: object_query selects a single instance, there are no validators if it doesn't exist
+        :return: (etag, last_modified) tuple or None
+    """
+    if request.include_tree or not isinstance(object_query, sqlalchemy.orm.Query):
+        return None
+
+    aggregates = [sqlalchemy.func.count()]
+    version_column = safrs_object.__mapper__.version_id_col
+    if version_column is not None:
+        aggregates.append(sqlalchemy.func.sum(version_column))
+    modified_column = None
+    if safrs_object._s_modified_column:
+        modified_column = getattr(safrs_object, safrs_object._s_modified_column)
+        aggregates.append(sqlalchemy.func.max(modified_column))
+    if len(aggregates) == 1:
+        return None
+
+    try:
+        # the savepoint is rolled back on failure so the transaction can still be used
+        with object_query.session.begin_nested():
+            fingerprint = tuple(
+                object_query.order_by(None).with_entities(*aggregates).one()
+            )
+    except sqlalchemy.exc.SQLAlchemyError as exc:
+        safrs.log.info("Failed to compute the validators for {}: {}".format(safrs_object, exc))
+        return None
+    if instance and not fingerprint[0]:
+        return None
+
+    last_modified = fingerprint[-1] if modified_column is not None else None
+    if isinstance(last_modified, datetime.datetime):
+        if last_modified.tzinfo is not None:
+            last_modified = last_modified.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        last_modified = last_modified.replace(microsecond=0)
+    elif isinstance(last_modified, datetime.date):
+        last_modified = datetime.datetime.combine(last_modified, datetime.time())
+    else:
+        last_modified = None
+
+    etag_data = repr(
+        (
+            request.url,
+            request.headers.get("Accept"),
+            request.compact_links,
+            fingerprint,
+            key,
+        )
+    )
+    etag = hashlib.sha1(etag_data.encode("utf-8")).hexdigest()
+    return etag, last_modified
+
+
 def get_included(data, limit, include="", level=0):
     """
         return a set of included items
@@ -241,6 +873,12 @@ def get_included(data, limit, include="", level=0):
                 pass
             elif not included or included in result:
                 continue
+            if isinstance(included, sqlalchemy.orm.Query):
+                # lazy="dynamic": include the items of the linkage, cfr. query_relationship_linkage
+                target = instance.__mapper__.relationships[relationship].mapper.class_
+                included = included.order_by(
+                    *[getattr(target, col.name) for col in target.id_type.columns]
+                )
             try:
                 # This works on sqlalchemy.orm.dynamic.AppenderBaseQuery
                 included = included[:limit]
@@ -269,6 +907,318 @@ def get_included(data, limit, include="", level=0):
     return result
 
 
+def get_relationship_linkage(instances, limit):
+    """
+        Fetch the to-many relationship linkage of the serialized instances:
+        the related ids and counts of all instances are retrieved with one query per
+        relationship instead of querying every relationship of every instance
+        in SAFRSBase._s_jsonapi_encode
+        :param instances: SAFRSBase instances that will be serialized
+        :param limit: max number of related ids per instance
+        :return: dict, {relationship: {instance id: (count, linkage data)}}
+    """
+    result = {}
+    if not get_config("ENABLE_RELATIONSHIPS"):
+        return result
+
+    # The relationship data is only encoded for the include= relationships
+    rel_names = request.included_relationships
+
+    instances_by_class = {}
+    for instance in instances:
+        if isinstance(instance, SAFRSBase):
+            instances_by_class.setdefault(type(instance), set()).add(instance)
+
+    for safrs_object, cls_instances in instances_by_class.items():
+        for relationship in safrs_object._s_get_plan().relationships:
+            if relationship.key not in rel_names or relationship.direction == MANYTOONE:
+                continue
+            if not issubclass(relationship.mapper.class_, SAFRSBase):
+                continue
+            try:
+                # a failed statement aborts the transaction on some backends (e.g. postgres),
+                # the savepoint is rolled back so the fallback queries can still be executed
+                with safrs.DB.session.begin_nested():
+                    linkage = query_relationship_linkage(
+                        safrs_object, relationship, cls_instances, limit
+                    )
+            except sqlalchemy.exc.SQLAlchemyError as exc:
+                # e.g. window functions aren't supported by the backend,
+                # the linkage will be queried per instance
+                safrs.log.info(
+                    "Failed to query {} linkage: {}".format(relationship, exc)
+                )
+                continue
+            result.setdefault(relationship, {}).update(linkage)
+
+    return result
+
+
+def query_relationship_linkage(safrs_object, relationship, instances, limit):
+    """
+        Query the linkage of a to-many relationship for a number of instances.
+        The related rows are numbered per instance with a window function so
+        at most limit ids are returned for every instance
+        :param safrs_object: SAFRSBase subclass
+        :param relationship: to-many relationship of safrs_object
+        :param instances: safrs_object instances
+        :param limit: max number of related ids per instance of a lazy="dynamic" relationship
+        :return: dict, {instance id: (count, linkage data)}
+    """
+    target = relationship.mapper.class_
+    target_alias = sqlalchemy.orm.aliased(target)
+    parent_columns = [getattr(safrs_object, col.name) for col in safrs_object.id_type.columns]
+    child_columns = [getattr(target_alias, col.name) for col in target.id_type.columns]
+
+    # the ids are listed in the relationship order, like the included items (cfr. get_included)
+    order_by = child_columns
+    if relationship.order_by:
+        adapter = sqlalchemy.sql.util.ClauseAdapter(sqlalchemy.inspect(target_alias).selectable)
+        order_by = [adapter.traverse(expr) for expr in relationship.order_by] + child_columns
+    row_number = sqlalchemy.func.row_number().over(
+        partition_by=parent_columns, order_by=order_by
+    )
+    count = sqlalchemy.func.count().over(partition_by=parent_columns)
+    columns = [col.label("parent_{}".format(i)) for i, col in enumerate(parent_columns)]
+    columns += [col.label("child_{}".format(i)) for i, col in enumerate(child_columns)]
+    columns += [row_number.label("row_number"), count.label("row_count")]
+
+    pk_values = [
+        tuple(getattr(instance, col.name) for col in safrs_object.id_type.columns)
+        for instance in instances
+    ]
+
+    # instances without related items aren't returned by the query
+    result = {instance.jsonapi_id: (0, []) for instance in instances}
+    parent_pk_count = len(parent_columns)
+    # the rows are numbered per parent, so the parents can be queried in chunks
+    for i in range(0, len(pk_values), IN_CHUNK_SIZE):
+        chunk = pk_values[i : i + IN_CHUNK_SIZE]
+        subquery = (
+            safrs.DB.session.query(*columns)
+            .select_from(safrs_object)
+            .join(getattr(safrs_object, relationship.key).of_type(target_alias))
+            .filter(get_in_criterion(parent_columns, chunk))
+            .subquery()
+        )
+        rows = safrs.DB.session.query(subquery).order_by(subquery.c.row_number)
+        if relationship.lazy == "dynamic":
+            # only the lazy="dynamic" relationships are limited, the linkage of
+            # the other relationships contains all related ids
+            rows = rows.filter(subquery.c.row_number <= limit)
+        for row in rows:
+            parent_id = safrs_object.id_type.get_id_from_values(row[:parent_pk_count])
+            child_id = target.id_type.get_id_from_values(row[parent_pk_count:-2])
+            data = result[parent_id][1]
+            data.append({"id": child_id, "type": target.__tablename__})
+            result[parent_id] = (row[-1], data)
+
+    return result
+
+
+def get_in_criterion(columns, values):
+    """
+        :param columns: list of columns
+        :param values: list of value tuples, ordered like the columns
+        :return: "columns IN values" criterion
+    """
+    if len(columns) == 1:
+        return columns[0].in_([value[0] for value in values])
+    # (a, b) IN ((..), (..)) isn't supported by all dialects
+    return sqlalchemy.or_(
+        *[sqlalchemy.and_(*[col == val for col, val in zip(columns, value)]) for value in values]
+    )
+
+
+def replace_many_to_many(parent, relationship, ids):
+    """
+        Replace the members of a MANYTOMANY relationship by writing the differences to the
+        association table: the rows of the removed members are deleted with one DELETE
+        and the rows of the new members are inserted with one executemany INSERT.
+        The related objects aren't loaded.
+        :param parent: SAFRSBase instance
+        :param relationship: MANYTOMANY relationship of the parent
+        :param ids: jsonapi ids of the new members
+        :return: False if the relationship can't be replaced like this, True otherwise
+    """
+    if not can_write_association_table(parent, relationship):
+        return False
+
+    secondary = relationship.secondary
+    child_class = relationship.mapper.class_
+    session = safrs.DB.session
+    session.flush()
+
+    parent_values = get_association_parent_values(parent, relationship)
+    parent_criteria = [sec_col == value for sec_col, value in parent_values]
+
+    # the child values in the association table of the requested ids
+    child_pk_columns = child_class.id_type.columns
+    child_columns = [col for col, sec_col in relationship.secondary_synchronize_pairs]
+    sec_child_columns = [sec_col for col, sec_col in relationship.secondary_synchronize_pairs]
+    pk_values = []
+    for id in ids:
+        primary_keys = child_class.id_type.get_pks(id)
+        pk_values.append(tuple(primary_keys.get(col.name) for col in child_pk_columns))
+    requested = {}
+    unique_pk_values = list(set(pk_values))
+    for i in range(0, len(unique_pk_values), IN_CHUNK_SIZE):
+        chunk = unique_pk_values[i : i + IN_CHUNK_SIZE]
+        rows = session.query(*(child_pk_columns + child_columns)).filter(
+            get_in_criterion(child_pk_columns, chunk)
+        )
+        for row in rows:
+            requested[tuple(row[: len(child_pk_columns)])] = tuple(row[len(child_pk_columns) :])
+    missing = [str(id) for id, values in zip(ids, pk_values) if values not in requested]
+    if missing:
+        raise NotFoundError('Invalid "{}" IDs: {}'.format(child_class.__name__, ", ".join(missing)))
+
+    existing = set(
+        tuple(row)
+        for row in session.execute(
+            sqlalchemy.select(sec_child_columns).where(sqlalchemy.and_(*parent_criteria))
+        )
+    )
+    requested = set(requested.values())
+    removed = list(existing - requested)
+    added = list(requested - existing)
+
+    for i in range(0, len(removed), IN_CHUNK_SIZE):
+        chunk = removed[i : i + IN_CHUNK_SIZE]
+        session.execute(
+            secondary.delete().where(
+                sqlalchemy.and_(get_in_criterion(sec_child_columns, chunk), *parent_criteria)
+            )
+        )
+    if added:
+        rows = []
+        for values in added:
+            row = {sec_col.key: value for sec_col, value in parent_values}
+            row.update((sec_col.key, value) for sec_col, value in zip(sec_child_columns, values))
+            rows.append(row)
+        session.execute(secondary.insert(), rows)
+
+    expire_association(parent, relationship)
+    return True
+
+
+def can_write_association_table(parent, relationship):
+    """
+        :param parent: SAFRSBase instance
+        :param relationship: relationship of the parent
+        :return: True if the relationship is a MANYTOMANY relationship that can be written
+                 to the association table without the orm
+    """
+    secondary = relationship.secondary
+    if (
+        relationship.direction != MANYTOMANY
+        or relationship.viewonly
+        or not isinstance(secondary, sqlalchemy.Table)
+        or not relationship.synchronize_pairs
+        or not relationship.secondary_synchronize_pairs
+    ):
+        return False
+    # let the orm handle the pending changes
+    return not sqlalchemy.inspect(parent).attrs[relationship.key].history.has_changes()
+
+
+def get_association_parent_values(parent, relationship):
+    """
+        :return: list of (association table column, value) tuples of the parent
+    """
+    parent_mapper = sqlalchemy.inspect(parent).mapper
+    return [
+        (sec_col, getattr(parent, parent_mapper.get_property_by_column(col).key))
+        for col, sec_col in relationship.synchronize_pairs
+    ]
+
+
+def expire_association(parent, relationship):
+    """
+        Expire the relationship collections in the session after the association table
+        of a MANYTOMANY relationship has been written without the orm
+    """
+    session = safrs.DB.session
+    child_class = relationship.mapper.class_
+    session.expire(parent, [relationship.key])
+    for reverse_property in relationship._reverse_property:
+        for instance in list(session.identity_map.values()):
+            if isinstance(instance, child_class):
+                session.expire(instance, [reverse_property.key])
+    # the association table isn't written by the orm, cfr. cache.on_commit
+    parent_table = sqlalchemy.inspect(parent).mapper.local_table
+    get_session_tables(session).update([relationship.secondary.name, parent_table.name])
+
+
+def get_related_identities(parent, relationship, children):
+    """
+        Find out which of the children are related to the parent with a query,
+        so the relationship doesn't have to be loaded
+        :param parent: SAFRSBase instance
+        :param relationship: to-many relationship of the parent
+        :param children: instances of the relationship class
+        :return: set of the primary key tuples of the related children
+    """
+    pk_columns = relationship.mapper.primary_key
+    idents = list({sqlalchemy.inspect(child).identity for child in children})
+    query = safrs.DB.session.query(*pk_columns).filter(
+        sqlalchemy.orm.with_parent(parent, relationship)
+    )
+    result = set()
+    for i in range(0, len(idents), IN_CHUNK_SIZE):
+        chunk = idents[i : i + IN_CHUNK_SIZE]
+        result.update(tuple(row) for row in query.filter(get_in_criterion(pk_columns, chunk)))
+    return result
+
+
+def add_to_many(parent, relationship, children):
+    """
+        Add the children to a to-many relationship without loading the relationship:
+        - ONETOMANY: the foreign keys of the children are set
+        - MANYTOMANY: the rows are inserted in the association table
+        Other relationships (e.g. viewonly or with a custom join) are appended by the orm.
+        :param parent: SAFRSBase instance
+        :param relationship: to-many relationship of the parent
+        :param children: instances that aren't related to the parent yet
+    """
+    if not children:
+        return
+    session = safrs.DB.session
+    parent_mapper = sqlalchemy.inspect(parent).mapper
+    parent_attr = sqlalchemy.inspect(parent).attrs[relationship.key]
+
+    if can_write_association_table(parent, relationship):
+        session.flush()
+        parent_values = get_association_parent_values(parent, relationship)
+        rows = []
+        for child in children:
+            row = {sec_col.key: value for sec_col, value in parent_values}
+            for col, sec_col in relationship.secondary_synchronize_pairs:
+                prop = relationship.mapper.get_property_by_column(col)
+                row[sec_col.key] = getattr(child, prop.key)
+            rows.append(row)
+        session.execute(relationship.secondary.insert(), rows)
+        expire_association(parent, relationship)
+    elif (
+        relationship.direction == ONETOMANY
+        and not relationship.viewonly
+        and relationship.synchronize_pairs
+        and not parent_attr.history.has_changes()
+    ):
+        for child in children:
+            for col, child_col in relationship.synchronize_pairs:
+                value = getattr(parent, parent_mapper.get_property_by_column(col).key)
+                setattr(child, relationship.mapper.get_property_by_column(child_col).key, value)
+            for reverse_property in relationship._reverse_property:
+                session.expire(child, [reverse_property.key])
+        if relationship.lazy != "dynamic":
+            session.expire(parent, [relationship.key])
+    else:
+        relation = getattr(parent, relationship.key)
+        for child in children:
+            relation.append(child)
+
+
 def jsonapi_format_response(data, meta=None, links=None, errors=None, count=None):
     """
     Create a response dict according to the json:api schema spec
@@ -283,6 +1233,9 @@ def jsonapi_format_response(data, meta=None, links=None, errors=None, count=None
         raise ValidationError("page[limit] error")
     meta["limit"] = limit
     meta["count"] = count
+    count_strategy = getattr(request, "count_strategy", None)
+    if count_strategy:
+        meta["count_strategy"] = count_strategy
 
     jsonapi = dict(version="1.0")
     included = list(
@@ -294,6 +1247,8 @@ def jsonapi_format_response(data, meta=None, links=None, errors=None, count=None
     )
     """if count >= 0:
         included = jsonapi_format_response(included, {}, {}, {}, -1)"""
+    instances = list(data) if isinstance(data, (list, set)) else [data]
+    request.relationship_linkage = get_relationship_linkage(instances + included, limit)
     result = dict(data=data)
 
     if errors:
@@ -310,6 +1265,67 @@ def jsonapi_format_response(data, meta=None, links=None, errors=None, count=None
     return result
 
 
+def jsonapi_response(result):
+    """
+        Create the response for a jsonapi document
+        :param result: jsonapi document, cfr. jsonapi_format_response
+        :return: json response, or msgpack response if the client prefers msgpack
+    """
+    if msgpack_requested():
+        return output_msgpack(result, 200)
+    return jsonify(result)
+
+
+def jsonapi_stream_response(instances, meta=None, links=None, count=None):
+    """
+        Stream the json:api document of a collection: the resource objects are
+        serialized one at a time while the rows are fetched, so the page
+        doesn't have to be kept in memory.
+        The links and meta are written after the data because they may
+        depend on the fetched rows (cfr. paginate). Included resources aren't supported.
+        :param instances: iterable of SAFRSBase instances, cfr. paginate(stream=True)
+        :return: flask response
+    """
+
+    def generate():
+        yield '{"data":['
+        for i, instance in enumerate(instances):
+            if i:
+                yield ","
+            yield flask_json.dumps(instance, separators=(",", ":"))
+        document = jsonapi_format_response([], meta, links, None, count)
+        del document["data"]
+        # the other top-level members follow "data" in the sorted output of jsonify
+        yield "]," + flask_json.dumps(document, separators=(",", ":"))[1:] + "\n"
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype=current_app.config["JSONIFY_MIMETYPE"]
+    )
+
+
+def jsonapi_ndjson_response(object_query):
+    """
+        Stream the rows of object_query as newline-delimited json,
+        one resource object (without links and relationships) per line.
+        The rows are fetched in batches, with a server-side cursor if the dbapi supports it
+        :param object_query: SQLAalchemy query object
+        :return: flask response
+    """
+
+    def generate():
+        for instance in object_query.yield_per(STREAM_BATCH_SIZE):
+            resource = dict(
+                attributes=instance.to_dict(),
+                id=instance.jsonapi_id,
+                type=instance._s_type,
+            )
+            yield flask_json.dumps(resource, separators=(",", ":")) + "\n"
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype="application/x-ndjson"
+    )
+
+
 class SAFRSRestAPI(Resource):
     """
         Flask webservice wrapper for the underlying Resource Object:
@@ -366,6 +1382,7 @@ class SAFRSRestAPI(Resource):
         """
         self.object_id = self.SAFRSObject.object_id
 
+    @cached_response
     def get(self, **kwargs):
         """
             responses :
@@ -403,6 +1420,10 @@ class SAFRSRestAPI(Resource):
 
         if id:
             # Retrieve a single instance
+            validators = self.get_instance_validators(id)
+            response = not_modified_response(validators)
+            if response is not None:
+                return response
             instance = self.SAFRSObject.get_instance(id)
             data = instance
             links = {"self": instance._s_url}
@@ -414,11 +1435,38 @@ class SAFRSRestAPI(Resource):
         else:
             # retrieve a collection, filter and sort
             instances = jsonapi_filter(self.SAFRSObject)
+            # conditional request: compare the validators before the rows are fetched
+            validators = get_validators(self.SAFRSObject, instances)
+            response = not_modified_response(validators)
+            if response is not None:
+                return response
             instances = jsonapi_sort(instances, self.SAFRSObject)
+            instances = jsonapi_eager_load(instances, self.SAFRSObject)
+            if get_columnar_mimetype():
+                # The columnar representations are created in Api.make_response, cfr. columnar.py
+                links, data, count = paginate(instances, self.SAFRSObject)
+                return ColumnarPage(self.SAFRSObject, data, links, count)
+            if get_config("STREAM_RESPONSES") and not request.include_tree and not msgpack_requested():
+                links, instances, count = paginate(instances, self.SAFRSObject, stream=True)
+                response = jsonapi_stream_response(instances, meta, links, count)
+                return set_validators(response, validators)
             links, data, count = paginate(instances, self.SAFRSObject)
         # format the response: add the included objects
         result = jsonapi_format_response(data, meta, links, errors, count)
-        return jsonify(result)
+        return set_validators(jsonapi_response(result), validators)
+
+    def get_instance_validators(self, id):
+        """
+            :param id: jsonapi id of the instance
+            :return: validators of the instance response, cfr. get_validators
+        """
+        try:
+            primary_keys = self.SAFRSObject.id_type.get_pks(id)
+        except (AttributeError, ValueError, ValidationError):
+            # invalid id, this is handled by get_instance
+            return None
+        instance_query = self.SAFRSObject.query.filter_by(**primary_keys)
+        return get_validators(self.SAFRSObject, instance_query, instance=True)
 
     def patch(self, **kwargs):
         """
@@ -459,7 +1507,9 @@ class SAFRSRestAPI(Resource):
             raise ValidationError("Invalid ID")
 
         attributes = data.get("attributes", {})
-        attributes["id"] = id
+        # The primary keys can't be patched, they're converted to the column types because
+        # the instance may be returned from the identity map (cfr. SAFRSBase._s_get_by_pks)
+        attributes.update(self.SAFRSObject.id_type.get_pks(id))
         # Create the object instance with the specified id and json data
         # If the instance (id) already exists, it will be updated with the data
         instance = self.SAFRSObject.get_instance(id)
@@ -664,6 +1714,46 @@ class SAFRSRestAPI(Resource):
         return instances
 
 
+class SAFRSExportAPI(Resource):
+    """
+        Bulk export of the underlying SAFRSObject:
+        all the rows matching the filter[] arguments are streamed
+        in a single response, without pagination, e.g.
+        GET /Users/_export?format=ndjson
+    """
+
+    SAFRSObject = (
+        None
+    )  # Flask views will need to set this to the SQLAlchemy safrs.DB.Model class
+    method_name = "_export"  # url path, cfr. CLASSMETHOD_URL_FMT
+    export_formats = ("ndjson",)
+
+    def __init__(self, *args, **kwargs):
+        """
+            object_id is the function used to create the url parameter name
+        """
+        self.object_id = self.SAFRSObject.object_id
+
+    def get(self, **kwargs):
+        """
+            responses :
+                400 :
+                    description : Invalid export format
+            ---
+            HTTP GET: export the (filtered and sorted) collection
+        """
+        export_format = request.args.get("format", "ndjson")
+        if export_format not in self.export_formats:
+            raise ValidationError('Invalid export format "{}"'.format(export_format))
+
+        instances = jsonapi_filter(self.SAFRSObject)
+        instances = jsonapi_sort(instances, self.SAFRSObject)
+        load_only_attrs = get_load_only_attrs(self.SAFRSObject, {})
+        if load_only_attrs is not None:
+            instances = instances.options(sqlalchemy.orm.load_only(*load_only_attrs))
+        return jsonapi_ndjson_response(instances)
+
+
 class SAFRSRestMethodAPI(Resource):
     """
         Route wrapper for the underlying SAFRSBase jsonapi_rpc
@@ -834,6 +1924,7 @@ class SAFRSRestRelationshipAPI(Resource):
             # two same objects, the object_id should be different (i.e. append "2")
             self.child_object_id += "2"
 
+    @cached_response
     def get(self, **kwargs):
         """
             ---
@@ -846,11 +1937,14 @@ class SAFRSRestRelationshipAPI(Resource):
             The top-level links object MAY contain self and related links,
             as described above for relationship objects.
         """
-        parent, relation = self.parse_args(**kwargs)
+        # the relationship isn't loaded for to-many relationships: only the requested page is retrieved
+        parent = self.get_parent(**kwargs)
         child_id = kwargs.get(self.child_object_id)
         errors = {}
+        validators = None
 
         if child_id:
+            relation = getattr(parent, self.rel_name)
             child = self.child_class.get_instance(child_id)
             # If {ChildId} is passed in the url, return the child object
             # there's a difference between to-one and -to-many relationships:
@@ -863,6 +1957,17 @@ class SAFRSRestRelationshipAPI(Resource):
                 return "Not Found", 404
         # elif type(relation) == self.child_class: # ==>
         elif self.SAFRSObject.relationship.direction == MANYTOONE:
+            relation = getattr(parent, self.rel_name)
+            # the child id is part of the etag: the parent may refer to another child
+            validators = get_validators(
+                self.child_class,
+                self.child_class.query.filter_by(**self.child_class.id_type.get_pks(relation.jsonapi_id)),
+                relation.jsonapi_id,
+                instance=True,
+            )
+            response = not_modified_response(validators)
+            if response is not None:
+                return response
             data = instance = relation
             meta = {"direction": "TOONE"}
             links = {"self": instance._s_url}
@@ -873,15 +1978,22 @@ class SAFRSRestRelationshipAPI(Resource):
 
         else:
             # No {ChildId} given:
-            # return a list of all relationship items
-            data = [item for item in relation if isinstance(item, SAFRSBase)]
+            # return a page of the relationship items, the query is correlated with the parent
+            # so the filter, sort, count and limit are applied to the items of the parent
             meta = {"direction": "TOMANY"}
-            instances = jsonapi_filter(self.child_class)
+            relationship = getattr(self.parent_class, self.rel_name)
+            instances = self.child_class.query.filter(sqlalchemy.orm.with_parent(parent, relationship))
+            instances = jsonapi_filter(self.child_class, instances)
+            validators = get_validators(self.child_class, instances)
+            response = not_modified_response(validators)
+            if response is not None:
+                return response
             instances = jsonapi_sort(instances, self.child_class)
+            instances = jsonapi_eager_load(instances, self.child_class)
             links, data, count = paginate(instances, self.child_class)
 
         result = jsonapi_format_response(data, meta, links, errors, count)
-        return jsonify(result)
+        return set_validators(jsonapi_response(result), validators)
 
     # Relationship patching
     def patch(self, **kwargs):
@@ -914,13 +2026,14 @@ class SAFRSRestRelationshipAPI(Resource):
             a resource identifier object corresponding to the new related resource.
             null, to remove the relationship.
         """
-        parent, relation = self.parse_args(**kwargs)
+        # the relationship isn't loaded here: a MANYTOMANY relationship may be replaced
+        # without loading its members, cfr. replace_many_to_many
+        parent = self.get_parent(**kwargs)
         json_reponse = request.get_jsonapi_payload()
         if not isinstance(json_reponse, dict):
             raise ValidationError("Invalid Object Type")
 
         data = json_reponse.get("data")
-        relation = getattr(parent, self.rel_name)
         obj_args = {self.parent_object_id: parent.jsonapi_id}
 
         if isinstance(data, dict):
@@ -955,17 +2068,21 @@ class SAFRSRestRelationshipAPI(Resource):
             # we should empty the relationship by setting it to []
             # otherwise it is an instance of InstrumentedList and we have to empty it
             # ( we could loop all items but this is slower for large collections )
-            tmp_rel = []
             for child in data:
-                if not isinstance(child, dict):
+                if not isinstance(child, dict) or child.get("id") is None:
                     raise ValidationError("Invalid data object")
-                child_instance = self.child_class.get_instance(child["id"])
-                tmp_rel.append(child_instance)
-
-            if isinstance(relation, sqlalchemy.orm.collections.InstrumentedList):
-                relation[:] = tmp_rel
+            child_ids = [child["id"] for child in data]
+            if replace_many_to_many(parent, self.SAFRSObject.relationship, child_ids):
+                # only the changed association rows have been written
+                pass
             else:
-                setattr(parent, self.rel_name, tmp_rel)
+                # retrieve the children with one query, an error is raised for the invalid ids
+                tmp_rel = self.child_class._s_get_instances(child_ids)
+                relation = getattr(parent, self.rel_name)
+                if isinstance(relation, sqlalchemy.orm.collections.InstrumentedList):
+                    relation[:] = tmp_rel
+                else:
+                    setattr(parent, self.rel_name, tmp_rel)
 
         elif data is None:
             # { data : null } //=> clear the relationship
@@ -1015,7 +2132,7 @@ class SAFRSRestRelationshipAPI(Resource):
         """
         errors = []
         kwargs["require_child"] = True
-        parent, relation = self.parse_args(**kwargs)
+        parent = self.get_parent(**kwargs)
 
         json_response = request.get_jsonapi_payload()
         if not isinstance(json_response, dict):
@@ -1043,25 +2160,36 @@ class SAFRSRestRelationshipAPI(Resource):
             result = [child]
 
         else:  # direction is TOMANY => append the items to the relationship
+            child_ids = []
             for item in data:
-                if not isinstance(json_response, dict):
+                if not isinstance(item, dict):
                     raise ValidationError("Invalid data type")
                 child_id = item.get("id", None)
                 if child_id is None:
                     errors.append("no child id {}".format(data))
                     safrs.log.error(errors)
                     continue
-                child = self.child_class.get_instance(child_id)
-
-                if not child:
-                    errors.append("invalid child id {}".format(child_id))
-                    safrs.log.error(errors)
+                child_ids.append(child_id)
+            # retrieve the children with one query, an error is raised for the invalid ids
+            children = self.child_class._s_get_instances(child_ids)
+            # the relationship isn't loaded: the children that are already related
+            # are looked up with a query and the response contains the requested children
+            relationship = self.SAFRSObject.relationship
+            members = get_related_identities(parent, relationship, children)
+            result = []
+            added = []
+            identities = set()
+            for child in children:
+                identity = sqlalchemy.inspect(child).identity
+                if identity in identities:
                     continue
-                if not child in relation:
-                    relation.append(child)
-            result = [item for item in relation]
+                identities.add(identity)
+                result.append(child)
+                if identity not in members:
+                    added.append(child)
+            add_to_many(parent, relationship, added)
 
-        return jsonify({"data": result})
+        return jsonapi_response({"data": result})
 
     def delete(self, **kwargs):
         """
@@ -1102,12 +2230,17 @@ class SAFRSRestRelationshipAPI(Resource):
 
             :return: parent, child, relation
         """
+        parent = self.get_parent(**kwargs)
+        relation = getattr(parent, self.rel_name)
 
+        return parent, relation
+
+    def get_parent(self, **kwargs):
+        """
+            :return: the parent instance, an error is raised if the parent doesn't exist
+        """
         parent_id = kwargs.get(self.parent_object_id, None)
         if parent_id is None:
             raise ValidationError("Invalid Parent Id")
 
-        parent = self.parent_class.get_instance(parent_id)
-        relation = getattr(parent, self.rel_name)
-
-        return parent, relation
+        return self.parent_class.get_instance(parent_id)
@@ -16,6 +16,7 @@ import safrs
 from .config import get_config
 from .errors import ValidationError
 from ._api import HTTP_METHODS
+from .json_encoder import msgpack, MSGPACK_MIMETYPE
 
 # pylint: disable=too-many-ancestors, logging-format-interpolation
 class SAFRSRequest(Request):
@@ -29,21 +30,39 @@ class SAFRSRequest(Request):
     jsonapi_content_types = ["application/json", "application/vnd.api+json"]
     page_offset = 0
     page_limit = 100
+    page_after = None  # keyset pagination cursors, cfr. jsonapi.paginate
+    page_before = None
+    page_count = None  # page[count]=false: don't count the collection, None if page[count] isn't set
+    count_strategy = None  # the strategy used to count the paginated collection
     is_jsonapi = False
     filters = {}
+    filter_operators = []  # (column name, operator, value) tuples from filter[col][op]
     filter = '' # filter is the custom filter, used as an argument by _s_filter
+    include_tree = {}  # parsed include= relationship paths
+    included_relationships = frozenset()  # names of the relationships in the include= paths
+    excluded_relationships = frozenset()  # names of the relationships in the exclude= arg
+    exclude_all = False  # exclude=+all: exclude all relationships that aren't included
+    compact_links = False  # omit the resource and relationship links, cfr. COMPACT_LINKS
+    relationship_linkage = {}  # to-many linkage of the serialized instances, cfr. jsonapi_format_response
 
     def __init__(self, *args, **kwargs):
         """
             constructor
         """
         super().__init__(*args, **kwargs)
-        if self.content_type in self.jsonapi_content_types:
+        if self.content_type in self.jsonapi_content_types or self.is_msgpack:
             self.is_jsonapi = True
             self.parameter_storage_class = TypeConversionDict
 
         self.parse_jsonapi_args()
 
+    @property
+    def is_msgpack(self):
+        """
+            :return: True if the payload is msgpack encoded
+        """
+        return msgpack is not None and self.content_type == MSGPACK_MIMETYPE
+
     def get_jsonapi_payload(self):
         """
             :return: jsonapi request payload
@@ -55,7 +74,13 @@ class SAFRSRequest(Request):
             return None
         if self.method not in HTTP_METHODS:
             abort(500)
-        result = self.get_json()
+        if self.is_msgpack:
+            try:
+                result = msgpack.unpackb(self.get_data(), raw=False)
+            except (ValueError, msgpack.UnpackException) as exc:
+                raise ValidationError("Invalid msgpack Payload : {}".format(exc))
+        else:
+            result = self.get_json()
         if not isinstance(result, dict):
             raise ValidationError("Invalid JSON Payload : {}".format(result))
         return result
@@ -65,8 +90,12 @@ class SAFRSRequest(Request):
             parse the jsonapi request arguments:
             - page[offset]
             - page[limit]
-            - filter[]
+            - page[after], page[before]
+            - page[count]
+            - filter[], filter[][operator]
             - fields[]
+            - include, exclude
+            - compact_links
         """
         self.page_limit = self.args.get(
             "page[limit]", get_config("MAX_PAGE_LIMIT"), type=int
@@ -81,22 +110,62 @@ class SAFRSRequest(Request):
             pass
             # del self.args['page[offset]']
 
+        # An empty cursor is allowed: page[after]= starts at the first page
+        # and page[before]= at the last page
+        self.page_after = self.args.get("page[after]", None)
+        self.page_before = self.args.get("page[before]", None)
+        page_count = self.args.get("page[count]", None)
+        if page_count is not None:
+            self.page_count = page_count.lower() not in ("false", "0")
+        compact_links = self.args.get("compact_links", None)
+        if compact_links is None:
+            self.compact_links = bool(get_config("COMPACT_LINKS"))
+        else:
+            self.compact_links = compact_links.lower() not in ("false", "0")
+
         self.filters = {}
+        self.filter_operators = []
         self.fields = {}
         # Parse the jsonapi filter[] and fields[] args
         for arg, val in self.args.items():
             if arg == 'filter':
                 self.filter = val
 
-            filter_attr = re.search(r"filter\[(\w+)\]", arg)
+            # filter[col] or filter[col][operator], eg. filter[age][gt]
+            filter_attr = re.match(r"filter\[(\w+)\](?:\[(\w+)\])?$", arg)
             if filter_attr:
-                col_name = filter_attr.group(1)
-                if not col_name.startswith("_"):  # maybe validate col_name?
+                col_name, operator = filter_attr.groups()
+                if col_name.startswith("_"):  # maybe validate col_name?
+                    pass
+                elif operator is None:
                     self.filters[col_name] = val
+                else:
+                    self.filter_operators.append((col_name, operator, val))
 
             # https://jsonapi.org/format/#fetching-sparse-fieldsets
             fields_attr = re.search(r"fields\[(\w+)\]", arg)
             if fields_attr:
                 field_type = fields_attr.group(1)
                 if not val.startswith("_"):
-                    self.fields[field_type] = val.split(",")
+                    self.fields[field_type] = set(val.split(","))
+
+        # https://jsonapi.org/format/#fetching-includes
+        # parse the dot-separated relationship paths into a tree, e.g.
+        # include=author,comments.author => {"author": {}, "comments": {"author": {}}}
+        self.include_tree = {}
+        for path in self.args.get("include", safrs.SAFRS.DEFAULT_INCLUDED).split(","):
+            node = self.include_tree
+            for rel_name in path.split("."):
+                if rel_name:
+                    node = node.setdefault(rel_name, {})
+
+        # The relationship data is encoded for the relationships in the include= arg
+        # (not for the DEFAULT_INCLUDED relationships), cfr. SAFRSBase._s_jsonapi_encode
+        included = set()
+        for path in self.args.get("include", "").split(","):
+            included.update(path.split("."))
+        self.included_relationships = frozenset(included)
+        # exclude=rel1,rel2 or exclude=+all: the relationships aren't serialized
+        # (an unencoded "+" in the query string is decoded as a space)
+        self.excluded_relationships = frozenset(self.args.get("exclude", "").split(","))
+        self.exclude_all = not self.excluded_relationships.isdisjoint(("+all", " all"))
@@ -2,6 +2,7 @@
 safrs_types.py
 """
 import sys
+import functools
 import uuid
 import datetime
 import hashlib
@@ -178,12 +179,30 @@ class SAFRSID:
 
         return getattr(obj, self.primary_keys[0])
 
+    @classmethod
+    def get_id_from_values(cls, values):
+        """
+            Retrieve the id string derived from the pk values, ordered like cls.columns
+        """
+        if len(cls.columns) > 1:
+            return cls.delimiter.join([str(val) for val in values])
+
+        return values[0]
+
     @classmethod
     def get_pks(cls, id):
+        """
+            Convert the id string to a pk dict, the conversions are cached
+        """
+        return dict(cls._get_pks(str(id)))
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _get_pks(cls, id):
         """
             Convert the id string to a pk dict
         """
-        values = str(id).split(cls.delimiter)
+        values = id.split(cls.delimiter)
         result = dict()
         for pk_col, val in zip(cls.columns, values):
             if not val:
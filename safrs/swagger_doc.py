@@ -270,6 +270,40 @@ def get_swagger_doc_post_arguments(cls, method_name):
     safrs.LOGGER.critical("Shouldnt get here ({})".format(method_name))
 
 
+def swagger_export_doc(cls, tags=None):
+    """
+    swagger_export_doc: documentation of the export endpoint, cfr. SAFRSExportAPI
+    """
+
+    def swagger_doc_gen(func):
+
+        class_name = cls.__name__
+        doc = {
+            "tags": [class_name] if tags is None else tags,
+            "description": "Export all {} as newline-delimited json".format(cls._s_type),
+            "summary": "Export {}".format(cls._s_type),
+        }
+        doc["parameters"] = [
+            {
+                "name": "format",
+                "in": "query",
+                "type": "string",
+                "default": "ndjson",
+                "required": False,
+                "description": "Export format",
+            }
+        ]
+        doc["produces"] = ["application/x-ndjson"]
+        doc["responses"] = {
+            "200": {"description": "Success"},
+            "400": {"description": "Invalid export format"},
+        }
+
+        return swagger.doc(doc)(func)
+
+    return swagger_doc_gen
+
+
 def swagger_method_doc(cls, method_name, tags=None):
     """
     swagger_method_doc
@@ -651,4 +685,33 @@ def default_paging_parameters():
         "description": "Max number of items",
     }
     parameters.append(param)
+
+    param = {
+        "type": "string",
+        "name": "page[after]",
+        "in": "query",
+        "format": "string",
+        "required": False,
+        "description": "Page cursor: return the items following this cursor (cfr. links.next)",
+    }
+    parameters.append(param)
+
+    param = {
+        "type": "string",
+        "name": "page[before]",
+        "in": "query",
+        "format": "string",
+        "required": False,
+        "description": "Page cursor: return the items preceding this cursor (cfr. links.prev)",
+    }
+    parameters.append(param)
+
+    param = {
+        "type": "boolean",
+        "name": "page[count]",
+        "in": "query",
+        "required": False,
+        "description": "Set to false to skip counting the total number of items",
+    }
+    parameters.append(param)
     return parameters
@@ -157,5 +157,17 @@ class Test_Api(unittest.TestCase):
         book.delete()
         user.delete()
 
+    def test_2_patch_user(self):
+        user = self.api.User()
+        user.name = 'TEST_NAME'
+        user.save()
+        endpoint = '{}Users/{}/'.format(API_ROOT, user.id)
+        data = {'data': {'type': 'Users', 'id': user.id, 'attributes': {'name': 'PATCHED_NAME'}}}
+        patched = requests.patch(endpoint, json = data).json()['data']
+        # the PATCH response contains the same representation as a GET of the resource
+        self.assertEqual(patched, requests.get(endpoint).json()['data'])
+        self.assertEqual(patched['attributes']['name'], 'PATCHED_NAME')
+        user.delete()
+
 
 log = logging.getLogger()